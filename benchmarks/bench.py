@@ -0,0 +1,172 @@
+"""Benchmark template test database creation and reload strategies.
+
+Generates a synthetic postgres template database with the given number of
+tables and rows per table, then for each reload strategy measures how long
+the runner takes to set up and tear down the test databases, how long
+reload_template_database takes after a write and the overhead of switching
+databases with use_template_database. Results are printed as one JSON object
+per strategy so runs can be compared across versions::
+
+    $ python benchmarks/bench.py --tables 50 --rows 100000 --label 0.5
+
+The postgres server is configured with the usual PGHOST, PGPORT, PGUSER and
+PGPASSWORD environment variables.
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+STRATEGIES = {
+    'clone': {},
+    'tables': {'RELOAD_MODE': 'tables'},
+    'copy': {'RELOAD_MODE': 'copy'},
+    'pool': {'POOL_SIZE': 2},
+    'snapshot': {'RESET_BACKEND': 'ttdb.backends.snapshot.SnapshotResetBackend'},
+}
+
+
+def configure():
+    """Configure django with a postgres database to benchmark against."""
+    import django
+    from django.conf import settings
+
+    settings.configure(
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+            },
+            'bench': {
+                'ENGINE': 'django.db.backends.postgresql_psycopg2',
+                'NAME': 'ttdb_bench',
+                'USER': os.environ.get('PGUSER', 'postgres'),
+                'PASSWORD': os.environ.get('PGPASSWORD', ''),
+                'HOST': os.environ.get('PGHOST', '127.0.0.1'),
+                'PORT': os.environ.get('PGPORT', ''),
+                'TEST': {
+                    'SERIALIZE': False,
+                },
+            },
+        },
+        TTDB=('bench',),
+        INSTALLED_APPS=(),
+    )
+    django.setup()
+
+
+def create_template(name, tables, rows):
+    """Create the template database filled with synthetic data."""
+    from django.db import connections
+
+    connection = connections['bench']
+    nodb_connection = connection.creation._nodb_connection
+    with nodb_connection.cursor() as cursor:
+        cursor.execute('DROP DATABASE IF EXISTS %s' % name)
+        cursor.execute('CREATE DATABASE %s' % name)
+    nodb_connection.close()
+
+    with connection.cursor() as cursor:
+        for i in range(tables):
+            cursor.execute(
+                'CREATE TABLE bench_%d (id serial PRIMARY KEY, value text, number int)' % i)
+            cursor.execute(
+                'INSERT INTO bench_%d (value, number) '
+                'SELECT md5(g::text), g FROM generate_series(1, %d) g' % (i, rows))
+        cursor.execute('SELECT pg_database_size(current_database())')
+        size = cursor.fetchone()[0]
+    connection.close()
+    return size
+
+
+def stats(durations):
+    """Return the minimum, median and maximum of the durations."""
+    durations = sorted(durations)
+    return {
+        'min': durations[0],
+        'median': durations[len(durations) // 2],
+        'max': durations[-1],
+    }
+
+
+def benchmark(strategy, repeat):
+    """Benchmark one strategy and return the results."""
+    from django.db import connections
+    from django.test.utils import override_settings
+    from ttdb import use_template_database
+    from ttdb.runner import TemplateDatabaseRunner
+    from ttdb.utils import reload_template_database
+
+    with override_settings(TTDB_OPTIONS={'bench': STRATEGIES[strategy]}):
+        runner = TemplateDatabaseRunner(verbosity=0, interactive=False)
+        start = time.time()
+        old_config = runner.setup_databases()
+        setup = time.time() - start
+
+        reloads = []
+        for i in range(repeat):
+            with connections['bench'].cursor() as cursor:
+                cursor.execute('UPDATE bench_0 SET number = number + 1 WHERE id = 1')
+            start = time.time()
+            reload_template_database('bench')
+            reloads.append(time.time() - start)
+
+        switches = []
+        for i in range(repeat):
+            start = time.time()
+            with use_template_database('bench', reload_after_test=False):
+                pass
+            switches.append(time.time() - start)
+
+        start = time.time()
+        runner.teardown_databases(old_config)
+        teardown = time.time() - start
+
+    return {
+        'setup': setup,
+        'reload': stats(reloads),
+        'switch': stats(switches),
+        'teardown': teardown,
+    }
+
+
+def main():
+    """Run the benchmarks and print the results."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--tables', type=int, default=10)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--strategy', action='append', choices=sorted(STRATEGIES))
+    parser.add_argument('--label', default='', help='e.g. the ttdb version')
+    parser.add_argument('--reuse', action='store_true',
+                        help='reuse the template database from a previous run')
+    args = parser.parse_args()
+
+    configure()
+    if not args.reuse:
+        size = create_template('ttdb_bench', args.tables, args.rows)
+    else:
+        size = None
+
+    for strategy in args.strategy or ['clone', 'tables', 'copy', 'pool']:
+        result = benchmark(strategy, args.repeat)
+        result.update({
+            'label': args.label,
+            'strategy': strategy,
+            'tables': args.tables,
+            'rows': args.rows,
+            'size': size,
+        })
+        print(json.dumps(result, sort_keys=True))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
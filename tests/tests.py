@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
 import mock
+import os
 import threading
 import unittest
 
@@ -11,16 +12,37 @@ from django.test.utils import override_settings
 from django.db.backends.postgresql_psycopg2.base import DatabaseWrapper as PostgresqlDatabaseWrapper
 from django.db.backends.sqlite3.base import DatabaseWrapper as SqliteDatabaseWrapper
 from django.conf import settings
+from django.db import transaction
+from django.db.backends.base.creation import BaseDatabaseCreation
 
 from ttdb.runner import TemplateDatabaseRunner
 from ttdb import TemplateDBTestCase
 from ttdb import TemplateDBTransactionTestCase
 from ttdb import TemplateDBLiveServerTestCase
 from ttdb import use_template_database
+from ttdb.tracking import get_tracked_tables
+from ttdb.tracking import is_dirty
+from ttdb.tracking import mark_dirty
+from ttdb.tracking import reset_tracking
 
 from .models import Test as TestModel
 
 
+def run_in_thread(func):
+    """Call func in a new thread and close the default connection it opened."""
+    from django.db import connections
+
+    def target():
+        try:
+            func()
+        finally:
+            connections['default'].close()
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+
+
 class TestMethodDecorator(TestCase):
 
     """Test decorating a TestCase test class."""
@@ -111,6 +133,1242 @@ class TestReloadTemplateDatabase(TestCase):
         self.assertEqual(_create_test_db.call_count, 0) 
 
 
+class TestTemplateDatabasePool(TestCase):
+
+    """Test reloading the template test database from a spare pool."""
+
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._destroy_test_db')
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._create_test_db')
+    def test_reload_swaps_spare(self, _destroy_test_db, _create_test_db):
+        """Test a spare database is used instead of recreating the database."""
+        from django.db import connections
+
+        pool = mock.Mock()
+        pool.swap.return_value = True
+        with mock.patch.object(connections['development'].creation, 'ttdb_pool', pool, create=True):
+            with use_template_database('development'):
+                pass
+        self.assertEqual(pool.swap.call_count, 1)
+        self.assertEqual(_destroy_test_db.call_count, 0)
+        self.assertEqual(_create_test_db.call_count, 0)
+
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._destroy_test_db')
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._create_test_db')
+    def test_reload_empty_pool(self, _destroy_test_db, _create_test_db):
+        """Test the database is recreated when no spare could be created."""
+        from django.db import connections
+
+        pool = mock.Mock()
+        pool.swap.return_value = False
+        with mock.patch.object(connections['development'].creation, 'ttdb_pool', pool, create=True):
+            with use_template_database('development'):
+                pass
+        self.assertEqual(_destroy_test_db.call_count, 1)
+        self.assertEqual(_create_test_db.call_count, 1)
+
+
+class TestTemplateDatabasePoolRefill(unittest.TestCase):
+
+    """Test the pool keeps its size when a clone fails."""
+
+    def test_failed_clone_is_retried(self):
+        """Test a replacement clone is queued when the spare is missing."""
+        from ttdb.pool import TemplateDatabasePool
+
+        pool = TemplateDatabasePool(mock.Mock(), 1)
+        pool.spares.put(None)
+        self.assertFalse(pool.swap())
+        self.assertEqual(pool.tasks.get_nowait(), ('clone', None))
+
+
+class TestKeepTemplateDatabase(TestCase):
+
+    """Test reusing the template test database between test runs."""
+
+    def test_fingerprint(self):
+        """Test the fingerprint of an unchanged template database is stable."""
+        from django.db import connections
+        from ttdb.fingerprint import get_template_fingerprint
+
+        conn = connections['development']
+        self.assertEqual(get_template_fingerprint(conn), get_template_fingerprint(conn))
+        with override_settings(TTDB_VERSION='1'):
+            fingerprint = get_template_fingerprint(conn)
+        with override_settings(TTDB_VERSION='2'):
+            self.assertNotEqual(get_template_fingerprint(conn), fingerprint)
+
+    def test_keep_clean_database(self):
+        """Test an unmodified test database is kept on teardown."""
+        from django.db import connections
+
+        conn = connections['development']
+        reset_tracking(conn)
+        with override_settings(TTDB_KEEPDB=True):
+            with mock.patch('django.test.runner.DiscoverRunner.teardown_databases'):
+                with mock.patch.object(conn.creation, 'ttdb_fingerprint', 'abc', create=True):
+                    with mock.patch('ttdb.runner.set_database_fingerprint') as set_fingerprint:
+                        TemplateDatabaseRunner().teardown_databases([])
+        self.assertTrue(conn.creation.ttdb_keep)
+        set_fingerprint.assert_called_once_with(conn, 'test_django_ttdb', 'abc')
+        conn.creation.ttdb_keep = False
+
+    def test_keep_dirty_database(self):
+        """Test a modified test database gets no fingerprint on teardown."""
+        from django.db import connections
+
+        conn = connections['development']
+        reset_tracking(conn)
+        mark_dirty(conn)
+        with override_settings(TTDB_KEEPDB=True):
+            with mock.patch('django.test.runner.DiscoverRunner.teardown_databases'):
+                with mock.patch.object(conn.creation, 'ttdb_fingerprint', 'abc', create=True):
+                    with mock.patch('ttdb.runner.set_database_fingerprint') as set_fingerprint:
+                        with mock.patch('ttdb.runner.drop_database'):
+                            TemplateDatabaseRunner().teardown_databases([])
+        self.assertFalse(conn.creation.ttdb_keep)
+        self.assertEqual(set_fingerprint.call_count, 0)
+        conn.creation.ttdb_dropped = False
+        reset_tracking(conn)
+
+
+class TestConcurrentSetup(TestCase):
+
+    """Test the runner creating and dropping template test databases for django."""
+
+    @mock.patch('ttdb.runner.create_database_from_template')
+    def test_create_template_databases(self, create_database_from_template):
+        """Test the template is cloned up front and django is told to keep it."""
+        from django.db import connections
+
+        conn = connections['development']
+        creation = conn.creation
+        with mock.patch.object(creation, 'ttdb_defer_creation', False, create=True):
+            with mock.patch.object(creation, 'ttdb_precreated', False, create=True):
+                TemplateDatabaseRunner(interactive=False).create_template_databases()
+                self.assertTrue(creation.ttdb_precreated)
+        create_database_from_template.assert_called_once_with(conn, 'test_django_ttdb')
+
+    @mock.patch('ttdb.runner.database_exists', return_value=True)
+    @mock.patch('ttdb.runner.create_database_from_template')
+    def test_create_existing_database_interactive(self, create_database_from_template,
+                                                  database_exists):
+        """Test an existing test database is left to django in an interactive run."""
+        from django.db import connections
+
+        creation = connections['development'].creation
+        with mock.patch.object(creation, 'ttdb_defer_creation', False, create=True):
+            with mock.patch.object(creation, 'ttdb_precreated', False, create=True):
+                TemplateDatabaseRunner(interactive=True).create_template_databases()
+                self.assertFalse(creation.ttdb_precreated)
+        self.assertEqual(create_database_from_template.call_count, 0)
+
+    def test_create_precreated_database(self):
+        """Test django keeps a database the runner created."""
+        from django.db import connections
+
+        creation = connections['development'].creation
+        with mock.patch.object(creation, 'ttdb_precreated', True, create=True):
+            with mock.patch.object(creation, 'create_test_db_args', (), create=True):
+                with mock.patch.object(creation, 'create_test_db_kwargs', {}, create=True):
+                    with mock.patch.object(creation, '_old_create_test_db') as create:
+                        creation.create_test_db(verbosity=0)
+                    self.assertFalse(creation.ttdb_precreated)
+        self.assertTrue(create.call_args[1]['keepdb'])
+
+    @mock.patch('ttdb.runner.drop_database')
+    def test_drop_template_databases(self, drop_database):
+        """Test the test databases and the clones of parallel workers are dropped."""
+        from django.db import connections
+
+        conn = connections['development']
+        creation = conn.creation
+        runner = TemplateDatabaseRunner()
+        runner.parallel = 2
+        with mock.patch.object(creation, 'ttdb_keep', False, create=True):
+            with mock.patch.object(creation, 'ttdb_dropped', False, create=True):
+                with mock.patch.object(creation, 'ttdb_dropped_clones', False, create=True):
+                    runner.drop_template_databases()
+                    self.assertTrue(creation.ttdb_dropped)
+                    self.assertEqual(creation.ttdb_dropped_clones,
+                                     hasattr(creation, 'get_test_db_clone_settings'))
+        names = [call[0][1] for call in drop_database.call_args_list]
+        if hasattr(creation, 'get_test_db_clone_settings'):
+            self.assertEqual(sorted(names),
+                             ['test_django_ttdb', 'test_django_ttdb_1', 'test_django_ttdb_2'])
+        else:
+            self.assertEqual(names, ['test_django_ttdb'])
+
+    def test_destroy_dropped_database(self):
+        """Test django does not drop a database the runner dropped."""
+        from django.db import connections
+
+        creation = connections['development'].creation
+        with mock.patch.object(creation, 'ttdb_dropped', True, create=True):
+            with mock.patch.object(creation, 'ttdb_lazy', None, create=True):
+                with mock.patch.object(creation, '_old_destroy_test_db') as destroy:
+                    creation.destroy_test_db('django_ttdb', 0)
+                self.assertFalse(creation.ttdb_dropped)
+        self.assertTrue(destroy.call_args[1]['keepdb'])
+
+
+class TestParallelClones(TestCase):
+
+    """Test cloning the template database for parallel test workers."""
+
+    @unittest.skipUnless(hasattr(BaseDatabaseCreation, 'get_test_db_clone_settings'),
+                         'parallel test workers need Django 1.9')
+    @mock.patch('ttdb.runner.create_database_from_template')
+    def test_clone_for_each_worker(self, create_database_from_template):
+        """Test each worker gets a copy of the template database."""
+        from django.db import connections
+
+        conn = connections['development']
+        with mock.patch.object(conn.creation, 'ttdb_clones', [1, 2], create=True):
+            TemplateDatabaseRunner().clone_template_databases()
+        self.assertEqual(
+            sorted(call[0][1] for call in create_database_from_template.call_args_list),
+            ['test_django_ttdb_1', 'test_django_ttdb_2'])
+
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._destroy_test_db')
+    def test_reload_worker_database(self, _destroy_test_db):
+        """Test reloading recreates the database under its current name."""
+        from django.db import connections
+
+        conn = connections['development']
+        names = []
+
+        def create_test_db(*args, **kwargs):
+            names.append(conn.creation._get_test_db_name())
+            conn.settings_dict['NAME'] = names[-1]
+
+        with mock.patch.dict(conn.settings_dict, {'NAME': 'test_django_ttdb_3'}):
+            with mock.patch.object(conn.creation, '_old_create_test_db',
+                                   side_effect=create_test_db):
+                with use_template_database('development'):
+                    pass
+                self.assertEqual(conn.settings_dict['NAME'], 'test_django_ttdb_3')
+        self.assertEqual(names, ['test_django_ttdb_3'])
+
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._destroy_test_db')
+    def test_destroy_worker_database_suffix(self, _destroy_test_db):
+        """Test the suffix argument of django 2.2 selects a worker database."""
+        from django.db import connections
+
+        creation = connections['development'].creation
+        with mock.patch.object(creation, 'ttdb_dropped_clones', True, create=True):
+            with mock.patch.object(creation, 'get_test_db_clone_settings', create=True,
+                                   return_value={'NAME': 'test_django_ttdb_1'}) as clone_settings:
+                with mock.patch.object(creation, '_old_destroy_test_db') as destroy:
+                    creation.destroy_test_db('django_ttdb', 0, suffix='1')
+        clone_settings.assert_called_once_with('1')
+        self.assertTrue(destroy.call_args[1]['keepdb'])
+
+    @unittest.skipUnless(hasattr(BaseDatabaseCreation, 'clone_test_db'),
+                         'parallel test workers need Django 1.9')
+    def test_clone_suffix(self):
+        """Test the suffix argument of django 2.2 is deferred like a number."""
+        from django.db import connections
+
+        creation = connections['development'].creation
+        with mock.patch.object(creation, 'ttdb_clones', [], create=True):
+            creation.clone_test_db(suffix='1', verbosity=0)
+            self.assertEqual(creation.ttdb_clones, ['1'])
+
+    @unittest.skipUnless(hasattr(BaseDatabaseCreation, 'clone_test_db'),
+                         'parallel test workers need Django 1.9')
+    def test_clone_other_vendor(self):
+        """Test databases of other backends are cloned the way django does."""
+        from django.db import connections
+
+        conn = connections['development']
+        creation = conn.creation
+        with mock.patch.object(conn, 'vendor', 'sqlite'):
+            with mock.patch.object(creation, 'ttdb_clones', [], create=True):
+                with mock.patch.object(creation, '_old_clone_test_db') as clone:
+                    creation.clone_test_db(1, 0)
+                self.assertEqual(creation.ttdb_clones, [])
+        clone.assert_called_once_with(1, 0)
+
+
+class TestReloadOnlyDirty(TestCase):
+
+    """Test skipping the reload of unmodified template test databases."""
+
+    def test_is_write_statement(self):
+        """Test statements are classified as reads or writes."""
+        from ttdb.tracking import is_write_statement
+
+        self.assertFalse(is_write_statement('SELECT * FROM tests_test'))
+        self.assertFalse(is_write_statement('  /* comment */ select 1'))
+        self.assertFalse(is_write_statement('SAVEPOINT s1'))
+        self.assertTrue(is_write_statement('INSERT INTO tests_test VALUES (1)'))
+        self.assertTrue(is_write_statement('UPDATE tests_test SET test = 1'))
+        self.assertTrue(is_write_statement("SELECT nextval('tests_test_id_seq')"))
+        self.assertTrue(is_write_statement('CREATE TABLE t (id int)'))
+
+    def test_get_modified_tables(self):
+        """Test the tables modified by a statement are found."""
+        from ttdb.tracking import get_modified_tables
+
+        self.assertEqual(
+            get_modified_tables('INSERT INTO "tests_test" ("test") VALUES (%s)'),
+            set(['"tests_test"']))
+        self.assertEqual(
+            get_modified_tables('UPDATE "tests_test" SET "test" = %s'),
+            set(['"tests_test"']))
+        self.assertEqual(
+            get_modified_tables('TRUNCATE "a", "b" RESTART IDENTITY;'),
+            set(['"a"', '"b"']))
+        self.assertEqual(
+            get_modified_tables('DELETE FROM `tests_test` WHERE `id` = %s'),
+            set(['`tests_test`']))
+        self.assertIsNone(get_modified_tables('ALTER TABLE "tests_test" ADD x int'))
+
+    def test_copy_marks_dirty(self):
+        """Test COPY marks the connection dirty with unknown modifications."""
+        from ttdb.tracking import WriteTrackingCursorWrapper
+
+        db = mock.Mock()
+        reset_tracking(db)
+        cursor = WriteTrackingCursorWrapper(mock.Mock(), db)
+        cursor.copy_expert('COPY tests_test FROM STDIN', None)
+        self.assertTrue(is_dirty(db))
+        self.assertIsNone(get_tracked_tables(db))
+        cursor.cursor.copy_expert.assert_called_once_with('COPY tests_test FROM STDIN', None)
+
+    @override_settings(TTDB_RELOAD_ONLY_DIRTY=True)
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._destroy_test_db')
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._create_test_db')
+    def test_no_reload_after_read(self, _destroy_test_db, _create_test_db):
+        """Test the database is not reloaded when it was only read."""
+        from django.db import connections
+
+        reset_tracking(connections['development'])
+        with use_template_database('development'):
+            self.assertEqual(TestModel.objects.count(), 4)
+        self.assertEqual(_destroy_test_db.call_count, 0)
+        self.assertEqual(_create_test_db.call_count, 0)
+
+    @override_settings(TTDB_RELOAD_ONLY_DIRTY=True)
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._destroy_test_db')
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._create_test_db')
+    def test_reload_after_write(self, _destroy_test_db, _create_test_db):
+        """Test the database is reloaded when it was written to."""
+        from django.db import connections
+
+        reset_tracking(connections['development'])
+        with use_template_database('development'):
+            with connections['default'].cursor() as cursor:
+                cursor.execute('UPDATE tests_test SET test = test')
+        self.assertEqual(_destroy_test_db.call_count, 1)
+        self.assertEqual(_create_test_db.call_count, 1)
+
+    @override_settings(TTDB_RELOAD_ONLY_DIRTY=True)
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._destroy_test_db')
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._create_test_db')
+    def test_reload_after_thread_write(self, _destroy_test_db, _create_test_db):
+        """Test a write from a thread started by the test is tracked."""
+        from django.db import connections
+
+        reset_tracking(connections['development'])
+        with use_template_database('development'):
+            run_in_thread(lambda: TestModel.objects.update(test='x'))
+        self.assertEqual(_destroy_test_db.call_count, 1)
+        self.assertEqual(_create_test_db.call_count, 1)
+
+
+class TestRestoreModifiedTables(TestCase):
+
+    """Test restoring only the modified tables of a template test database."""
+
+    @override_settings(TTDB_RELOAD_MODE='tables')
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._destroy_test_db')
+    def test_restore_modified_table(self, _destroy_test_db):
+        """Test the modified table is restored without recreating the database."""
+        from django.db import connections
+
+        reset_tracking(connections['development'])
+        with use_template_database('development'):
+            TestModel.objects.create(test='new')
+            self.assertEqual(TestModel.objects.count(), 5)
+        self.assertEqual(_destroy_test_db.call_count, 0)
+        self.assertEqual(TestModel.objects.using('development').count(), 4)
+
+    @override_settings(TTDB_RELOAD_MODE='tables')
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._destroy_test_db')
+    def test_restore_thread_write(self, _destroy_test_db):
+        """Test a table modified by a thread started by the test is restored."""
+        from django.db import connections
+
+        reset_tracking(connections['development'])
+        with use_template_database('development'):
+            run_in_thread(lambda: TestModel.objects.create(test='new'))
+            self.assertEqual(TestModel.objects.count(), 5)
+        self.assertEqual(_destroy_test_db.call_count, 0)
+        self.assertEqual(TestModel.objects.using('development').count(), 4)
+
+
+class TestRestoreAllTables(TestCase):
+
+    """Test restoring every table of a template test database."""
+
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._destroy_test_db')
+    def test_restore_all_tables(self, _destroy_test_db):
+        """Test every table is restored without recreating the database."""
+        from django.db import connections
+        from ttdb.incremental import snapshot_all_tables
+
+        conn = connections['development']
+        snapshot_all_tables(conn)
+        reset_tracking(conn)
+        with mock.patch.object(conn.creation, 'ttdb_reload_mode', 'copy', create=True):
+            with use_template_database('development'):
+                TestModel.objects.all().delete()
+        self.assertEqual(_destroy_test_db.call_count, 0)
+        self.assertEqual(TestModel.objects.using('development').count(), 4)
+
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._destroy_test_db')
+    def test_restore_untracked_writes(self, _destroy_test_db):
+        """Test tables are restored without RELOAD_ONLY_DIRTY when no write was tracked."""
+        from django.db import connections
+        from ttdb.incremental import snapshot_all_tables
+
+        conn = connections['development']
+        snapshot_all_tables(conn)
+        with mock.patch.object(conn.creation, 'ttdb_reload_mode', 'copy', create=True):
+            with use_template_database('development'):
+                TestModel.objects.all().delete()
+                # For example a write through another thread's connection.
+                reset_tracking(conn)
+        self.assertEqual(_destroy_test_db.call_count, 0)
+        self.assertEqual(TestModel.objects.using('development').count(), 4)
+
+
+class TestReorderTemplateTests(unittest.TestCase):
+
+    """Test grouping tests by template database."""
+
+    def test_reorder(self):
+        """Test tests are grouped by template and read only tests run first."""
+        from ttdb.suite import reorder_template_tests
+
+        class Plain(TestCase):
+            def test(self):
+                pass
+
+        class Reloading(TemplateDBTransactionTestCase):
+            template_database = 'development'
+
+            def test(self):
+                pass
+
+        class ReadOnly(TemplateDBTestCase):
+            template_database = 'development'
+
+            def test(self):
+                pass
+
+        class Method(TestCase):
+            @use_template_database('development', reload_after_test=False)
+            def test(self):
+                pass
+
+        tests = [ReadOnly('test'), Plain('test'), Reloading('test'), Method('test')]
+        ordered = reorder_template_tests(tests, (TestCase,))
+        self.assertEqual(
+            [test.__class__ for test in ordered],
+            [Plain, ReadOnly, Method, Reloading])
+
+
+class TestTemplateScope(TestCase):
+
+    """Test sharing the template test database within a class or module."""
+
+    @mock.patch('ttdb.utils.reload_template_database')
+    def test_class_scope(self, reload_template_database):
+        """Test the database is only reloaded for a test of another class."""
+        from django.db import connections
+        from ttdb.utils import enable_template_database
+        from ttdb.utils import finish_template_test
+        from ttdb.utils import restore_default_database
+
+        connection = connections['development']
+        with mock.patch.object(connection, 'ttdb_reload_pending', False, create=True):
+            finish_template_test('development', 'class', 'tests.A')
+            restore_default_database(
+                enable_template_database('development', scope_key='tests.A'))
+            self.assertEqual(reload_template_database.call_count, 0)
+            restore_default_database(
+                enable_template_database('development', scope_key='tests.B'))
+            self.assertEqual(reload_template_database.call_count, 1)
+
+    def test_reorder_scopes(self):
+        """Test tests sharing the database in a module run together."""
+        from ttdb.suite import reorder_template_tests
+
+        @use_template_database('development', scope='module')
+        class First(TestCase):
+            def test(self):
+                pass
+
+        @use_template_database('development')
+        class Reloading(TestCase):
+            def test(self):
+                pass
+
+        @use_template_database('development', scope='module')
+        class Second(TestCase):
+            def test(self):
+                pass
+
+        tests = [First('test'), Reloading('test'), Second('test')]
+        ordered = reorder_template_tests(tests, (TestCase,))
+        self.assertEqual(
+            [test.__class__ for test in ordered], [First, Second, Reloading])
+
+
+class TestMethodRollback(TestCase):
+
+    """Test decorated TestCase methods are rolled back instead of reloading."""
+
+    @mock.patch('ttdb.utils.schedule_template_database_reload')
+    def test_rollback(self, schedule_template_database_reload):
+        """Test the changes of the method are rolled back."""
+        from django.db import connections
+
+        @use_template_database('development')
+        def test(testcase):
+            TestModel.objects.all().delete()
+            testcase.assertTrue(connections['default'].in_atomic_block)
+
+        test(self)
+        self.assertEqual(schedule_template_database_reload.call_count, 0)
+        self.assertEqual(TestModel.objects.using('development').count(), 4)
+
+
+@override_settings(TTDB_CACHED_MODELS=['tests.Test'])
+class TestReferenceCache(TemplateDBTestCase):
+
+    """Test serving reference data from the cache."""
+
+    template_database = 'development'
+    cache_reference_data = True
+
+    def test_cacheable(self):
+        """Test exact lookups are served without a query."""
+        from ttdb.cache import cacheable
+
+        with self.assertNumQueries(0):
+            self.assertEqual(len(cacheable(TestModel.objects.all())), 4)
+            self.assertEqual([obj.pk for obj in cacheable(TestModel.objects.filter(pk=2))], [2])
+
+    def test_not_cacheable(self):
+        """Test other querysets are evaluated."""
+        from ttdb.cache import cacheable
+
+        with self.assertNumQueries(1):
+            self.assertEqual(len(cacheable(TestModel.objects.order_by('pk'))), 4)
+
+
+class TestReferenceCacheFiles(unittest.TestCase):
+
+    """Test storing reference data snapshots."""
+
+    def setUp(self):
+        """Use a temporary directory as the temporary directory."""
+        import shutil
+        import tempfile
+
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        patcher = mock.patch('tempfile.gettempdir', return_value=self.tempdir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @unittest.skipUnless(hasattr(os, 'getuid'), 'needs file ownership')
+    def test_private_directory(self):
+        """Test the cache directory can only be accessed by the current user."""
+        from ttdb.cache import get_cache_directory
+
+        path = get_cache_directory()
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o700)
+        os.chmod(path, 0o777)
+        self.assertIsNone(get_cache_directory())
+
+    def test_outdated_snapshots_removed(self):
+        """Test storing a snapshot removes the older snapshots of the template."""
+        from ttdb.cache import get_cache_directory
+        from ttdb.cache import get_snapshot_path
+        from ttdb.cache import save_snapshot
+
+        directory = get_cache_directory()
+        save_snapshot(get_snapshot_path(directory, 'development', 'a'), {})
+        save_snapshot(get_snapshot_path(directory, 'development+orders', 'b'), {})
+        save_snapshot(get_snapshot_path(directory, 'development', 'c'), {})
+        self.assertEqual(sorted(os.listdir(directory)),
+                         ['development+orders-b.pickle', 'development-c.pickle'])
+
+    def test_sqlite_key(self):
+        """Test the key of a sqlite template changes with the template file."""
+        from ttdb.cache import get_snapshot_key
+
+        name = os.path.join(self.tempdir, 'template.sqlite3')
+        with open(name, 'w') as f:
+            f.write('a')
+        connection = mock.Mock(alias='development', vendor='sqlite',
+                               settings_dict={'ORIGINAL_NAME': name})
+        key = get_snapshot_key(connection)
+        self.assertEqual(get_snapshot_key(connection), key)
+        with open(name, 'w') as f:
+            f.write('ab')
+        self.assertNotEqual(get_snapshot_key(connection), key)
+        connection.settings_dict['ORIGINAL_NAME'] = ':memory:'
+        self.assertIsNone(get_snapshot_key(connection))
+
+
+class TestDeferReload(TestCase):
+
+    """Test deferring reloads until the template test database is used again."""
+
+    @override_settings(TTDB_DEFER_RELOAD=True)
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._destroy_test_db')
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._create_test_db')
+    def test_defer_reload(self, _destroy_test_db, _create_test_db):
+        """Test the reload happens when the database is switched to again."""
+        with use_template_database('development'):
+            pass
+        self.assertEqual(_destroy_test_db.call_count, 0)
+
+        with use_template_database('development', reload_after_test=False):
+            self.assertEqual(_destroy_test_db.call_count, 1)
+        self.assertEqual(_create_test_db.call_count, 1)
+
+
+class TestLazyCreation(TestCase):
+
+    """Test creating the template test database when it is first used."""
+
+    def test_lazy_creation(self):
+        """Test the deferred creation runs once, on the first switch."""
+        from django.db import connections
+
+        create = mock.Mock()
+        with mock.patch.object(connections['development'].creation,
+                               'ttdb_lazy', create, create=True):
+            with use_template_database('development', reload_after_test=False):
+                pass
+            with use_template_database('development', reload_after_test=False):
+                pass
+        self.assertEqual(create.call_count, 1)
+
+    @override_settings(TTDB_LAZY=True)
+    def test_defer_creation(self):
+        """Test only template databases the suite doesn't use are deferred."""
+        runner = TemplateDatabaseRunner()
+        runner.template_aliases = set(['development'])
+        self.assertFalse(runner.defer_creation('development'))
+        runner.template_aliases = set()
+        self.assertTrue(runner.defer_creation('development'))
+
+
+class TestTemplateDatabaseRoute(TestCase):
+
+    """Test routing the default database to a template test database."""
+
+    def test_nested_routes(self):
+        """Test each route restores the default database it replaced."""
+        from django.db import connections
+        from ttdb.routing import TemplateDatabaseRoute
+
+        default = connections['default']
+        outer = TemplateDatabaseRoute('development')
+        inner = TemplateDatabaseRoute('development')
+        outer.start()
+        self.assertIs(connections['default'], connections['development'])
+        self.assertEqual(list(connections), ['default'])
+        inner.start()
+        inner.stop()
+        self.assertIsInstance(connections['default'], PostgresqlDatabaseWrapper)
+        outer.stop()
+        self.assertIs(connections['default'], default)
+        self.assertIn('development', connections.databases)
+
+    def test_thread_inherits_route(self):
+        """Test threads started by the test use the route of the test."""
+        from django.db import connections
+        from ttdb.routing import TemplateDatabaseRoute
+
+        vendors = []
+
+        def record_vendor():
+            vendors.append(connections['default'].vendor)
+
+        route = TemplateDatabaseRoute('development')
+        route.start()
+        try:
+            thread = threading.Thread(target=record_vendor)
+            thread.start()
+            thread.join()
+            self.assertEqual(connections['default'].vendor, 'postgresql')
+        finally:
+            route.stop()
+        thread = threading.Thread(target=record_vendor)
+        thread.start()
+        thread.join()
+        self.assertEqual(vendors, ['postgresql', 'sqlite'])
+
+    def test_thread_keeps_own_route(self):
+        """Test a thread that stopped its route does not use the routes of others."""
+        from django.db import connections
+        from ttdb.routing import TemplateDatabaseRoute
+
+        own = TemplateDatabaseRoute('development')
+        own.start()
+        own.stop()
+        vendors = []
+        other_started = threading.Event()
+        test_done = threading.Event()
+
+        def other_test():
+            route = TemplateDatabaseRoute('development')
+            route.start()
+            other_started.set()
+            test_done.wait()
+            route.stop()
+
+        thread = threading.Thread(target=other_test)
+        thread.start()
+        other_started.wait()
+        try:
+            vendors.append(connections['default'].vendor)
+        finally:
+            test_done.set()
+            thread.join()
+        self.assertEqual(vendors, ['sqlite'])
+
+    def test_shared_route(self):
+        """Test a shared route applies to other threads."""
+        from django.db import connections
+        from ttdb.routing import TemplateDatabaseRoute
+
+        vendors = []
+        thread = threading.Thread(
+            target=lambda: vendors.append(connections['default'].vendor))
+        route = TemplateDatabaseRoute('development', shared=True)
+        route.start()
+        try:
+            thread.start()
+            thread.join()
+        finally:
+            route.stop()
+        self.assertEqual(vendors, ['postgresql'])
+
+
+class TestWaitForTemplate(unittest.TestCase):
+
+    """Test waiting for the sessions on the template database to go away."""
+
+    @override_settings(TTDB_CLONE_RETRIES=2)
+    @mock.patch('ttdb.utils.time.sleep')
+    @mock.patch('ttdb.utils.get_database_sessions', return_value=['pid 1'])
+    def test_template_in_use(self, get_database_sessions, sleep):
+        """Test an error listing the sessions is raised after the retries."""
+        from django.db import DatabaseError
+        from django.db import connections
+        from ttdb.utils import wait_for_template
+
+        with self.assertRaises(DatabaseError) as context:
+            wait_for_template(connections['development'])
+        self.assertIn('pid 1', str(context.exception))
+        self.assertEqual(get_database_sessions.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+
+
+class TestPrewarm(unittest.TestCase):
+
+    """Test prewarming copies of the template database."""
+
+    @override_settings(TTDB_OPTIONS={'development': {'PREWARM': ['test_table']}})
+    def test_prewarm(self):
+        """Test every relation in the PREWARM option is prewarmed."""
+        from ttdb.utils import prewarm_database
+
+        connection = mock.MagicMock(alias='development')
+        prewarm_database(connection)
+        cursor = connection.cursor.return_value.__enter__.return_value
+        cursor.execute.assert_called_once_with('SELECT pg_prewarm(%s)', ['test_table'])
+
+
+class TestRelaxDurability(TestCase):
+
+    """Test relaxing the durability of test databases kept for the whole run."""
+
+    @mock.patch('ttdb.runner.relax_durability')
+    def test_restored_database(self, relax_durability):
+        """Test a database whose tables are restored is relaxed once."""
+        from django.db import connections
+
+        creation = connections['development'].creation
+        with mock.patch.object(creation, 'ttdb_reload_mode', None, create=True):
+            with override_settings(TTDB_RELOAD_MODE='tables'):
+                TemplateDatabaseRunner().setup_reload_mode('development')
+        relax_durability.assert_called_once_with(connections['development'])
+
+    @mock.patch('ttdb.runner.relax_durability')
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._destroy_test_db')
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._create_test_db')
+    def test_recreated_database(self, _create_test_db, _destroy_test_db, relax_durability):
+        """Test the tables of a database that is recreated on reload stay logged."""
+        from django.db import connections
+
+        creation = connections['development'].creation
+        with mock.patch.object(creation, 'ttdb_reload_mode', None, create=True):
+            with override_settings(TTDB_RELOAD_MODE='clone', TTDB_UNLOGGED=True):
+                TemplateDatabaseRunner().setup_reload_mode('development')
+                with mock.patch('ttdb.utils.relax_durability') as utils_relax_durability:
+                    with use_template_database('development'):
+                        pass
+        self.assertEqual(_create_test_db.call_count, 1)
+        relax_durability.assert_called_once_with(connections['development'], tables=False)
+        self.assertEqual(utils_relax_durability.call_count, 0)
+
+    @mock.patch('ttdb.utils.prewarm_database')
+    @mock.patch('ttdb.utils.relax_durability')
+    @mock.patch('ttdb.utils.execute_without_database')
+    @mock.patch('ttdb.utils.wait_for_template')
+    @mock.patch('ttdb.utils.drop_database')
+    def test_clone(self, drop_database, wait_for_template, execute_without_database,
+                   relax_durability, prewarm_database):
+        """Test commits to every copy of the template don't wait for the log."""
+        from django.db import connections
+        from ttdb.utils import create_database_from_template
+
+        connection = connections['development']
+        create_database_from_template(connection, 'test_copy')
+        relax_durability.assert_called_once_with(connection, 'test_copy', tables=False)
+
+    @mock.patch('ttdb.utils.execute_without_database')
+    def test_synchronous_commit(self, execute_without_database):
+        """Test synchronous commit is disabled for a copy of the template."""
+        from ttdb.utils import relax_durability
+
+        connection = mock.MagicMock(alias='development')
+        connection.ops.quote_name.side_effect = lambda name: '"%s"' % name
+        with override_settings(TTDB_UNLOGGED=True):
+            relax_durability(connection, 'test_copy', tables=False)
+        execute_without_database.assert_called_once_with(
+            connection, 'ALTER DATABASE "test_copy" SET synchronous_commit = off')
+
+    @mock.patch('ttdb.pool.relax_durability')
+    @mock.patch('ttdb.pool.create_database_from_template')
+    def test_pool_spare(self, create_database_from_template, relax_durability):
+        """Test the spares of a pool are relaxed in the background."""
+        from ttdb.pool import TemplateDatabasePool
+
+        connection = mock.Mock()
+        connection.creation._get_test_db_name.return_value = 'test_django_ttdb'
+        name = TemplateDatabasePool(connection, 1).clone()
+        self.assertEqual(name, 'test_django_ttdb_ttdb1')
+        relax_durability.assert_called_once_with(connection, name)
+
+
+class TestAnalyzeTemplate(unittest.TestCase):
+
+    """Test analyzing the template database."""
+
+    def analyze(self, unanalyzed):
+        """Analyze a mocked template and return the executed statements."""
+        from ttdb.utils import analyze_template
+
+        source = mock.MagicMock()
+        cursor = source.cursor.return_value.__enter__.return_value
+        cursor.fetchone.return_value = unanalyzed
+        with mock.patch('ttdb.utils.get_source_connection', return_value=source):
+            analyze_template(mock.Mock(alias='development'))
+        return [call[0][0] for call in cursor.execute.call_args_list]
+
+    def test_analyze_modified(self):
+        """Test a template with modified tables is analyzed."""
+        self.assertEqual(self.analyze((1,))[-1], 'ANALYZE')
+
+    def test_skip_unmodified(self):
+        """Test an analyzed template is not analyzed again."""
+        self.assertNotIn('ANALYZE', self.analyze(None))
+
+
+class TestBuildSteps(unittest.TestCase):
+
+    """Test inspecting the steps that build a template database."""
+
+    def test_step_kind(self):
+        """Test steps are loaded depending on their extension."""
+        from ttdb.builder import get_step_kind
+        from ttdb.builder import get_step_table
+
+        self.assertEqual(get_step_kind('data/setup.sql'), 'sql')
+        self.assertEqual(get_step_kind('data/tests_test.CSV'), 'csv')
+        self.assertEqual(get_step_kind('tests.factories.load'), 'callable')
+        self.assertEqual(get_step_table('data/tests_test.csv'), 'tests_test')
+
+    def test_step_hash(self):
+        """Test the hash of a file step changes with its content."""
+        import tempfile
+        from ttdb.builder import get_step_hash
+
+        with tempfile.NamedTemporaryFile(suffix='.sql') as f:
+            f.write(b'SELECT 1;')
+            f.flush()
+            first = get_step_hash(f.name)
+            f.write(b'SELECT 2;')
+            f.flush()
+            self.assertNotEqual(get_step_hash(f.name), first)
+
+
+class TestLoadOrder(unittest.TestCase):
+
+    """Test ordering csv files by the foreign keys between their tables."""
+
+    foreign_keys = [
+        ('app_product', 'app_category'),
+        ('app_product', 'app_supplier'),
+        ('app_order', 'app_product'),
+        ('app_category', 'app_category'),
+        ('a', 'b'),
+        ('b', 'a'),
+    ]
+
+    def test_referenced_tables_first(self):
+        """Test tables are loaded after the tables they reference."""
+        from ttdb.builder import get_load_order
+
+        self.assertEqual(
+            get_load_order(self.foreign_keys, ['app_product', 'app_supplier', 'app_category']),
+            [[['app_category'], ['app_supplier']], [['app_product']]])
+
+    def test_cycle(self):
+        """Test tables referencing each other are loaded together."""
+        from ttdb.builder import get_load_order
+
+        self.assertEqual(
+            get_load_order(self.foreign_keys, ['a', 'b', 'app_supplier']),
+            [[['app_supplier']], [['a', 'b']]])
+
+    def test_referencing_tables(self):
+        """Test the tables referencing a table are truncated with it."""
+        from ttdb.builder import get_referencing_tables
+
+        self.assertEqual(
+            get_referencing_tables(self.foreign_keys, ['app_category']),
+            set(['app_category', 'app_product', 'app_order']))
+
+
+class TestLayers(unittest.TestCase):
+
+    """Test layered template databases."""
+
+    def test_layer_settings(self):
+        """Test a layered alias uses the settings of its base alias."""
+        from django.db import connections
+        from ttdb.builder import get_layer_settings
+
+        base = connections.databases['development']
+        settings_dict = get_layer_settings('development+orders')
+        self.assertEqual(settings_dict['NAME'], base['NAME'] + '_orders')
+        self.assertEqual(settings_dict['ENGINE'], base['ENGINE'])
+        self.assertNotIn('ORIGINAL_NAME', settings_dict)
+
+    def test_base_not_in_ttdb(self):
+        """Test the base of a layered alias has to be a template database."""
+        from django.core.exceptions import ImproperlyConfigured
+        from ttdb.builder import get_layer_settings
+
+        with self.assertRaises(ImproperlyConfigured):
+            get_layer_settings('default+orders')
+
+
+class TestResetBackend(TestCase):
+
+    """Test resetting the template test database with a reset backend."""
+
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._destroy_test_db')
+    @mock.patch('django.db.backends.base.creation.BaseDatabaseCreation._create_test_db')
+    def test_reset(self, _destroy_test_db, _create_test_db):
+        """Test the backend resets the database instead of recreating it."""
+        from django.db import connections
+
+        backend = mock.Mock()
+        backend.reset.return_value = True
+        with mock.patch.object(connections['development'].creation,
+                               'ttdb_reset_backend', backend, create=True):
+            with use_template_database('development'):
+                pass
+        self.assertEqual(backend.reset.call_count, 1)
+        self.assertEqual(_destroy_test_db.call_count, 0)
+        self.assertEqual(_create_test_db.call_count, 0)
+
+
+class TestTimings(unittest.TestCase):
+
+    """Test recording the timings of template database operations."""
+
+    def test_timed(self):
+        """Test timed operations are recorded and the signal is sent."""
+        from ttdb.signals import database_operation
+        from ttdb.timing import Timings
+        from ttdb.timing import timed
+
+        handler = mock.Mock()
+        database_operation.connect(handler)
+        try:
+            with mock.patch('ttdb.timing.timings', Timings()) as timings:
+                with timed('reload', 'development'):
+                    pass
+        finally:
+            database_operation.disconnect(handler)
+
+        self.assertEqual(len(timings.events), 1)
+        self.assertEqual(timings.events[0]['operation'], 'reload')
+        self.assertEqual(handler.call_count, 1)
+
+    def test_summarize(self):
+        """Test the summary totals operations and puts the slowest first."""
+        from ttdb.timing import Timings
+
+        timings = Timings()
+        timings.record('reload', 'development', 2.0)
+        timings.record('reload', 'development', 1.0)
+        timings.record('switch', 'development', 0.5)
+        self.assertEqual(timings.summarize(), [
+            ('reload', 'development', None, 2, 3.0),
+            ('switch', 'development', None, 1, 0.5),
+        ])
+
+
+class TestRunConcurrently(unittest.TestCase):
+
+    """Test running tasks in threads."""
+
+    def test_max_workers(self):
+        """Test every task is run with a bounded number of threads."""
+        from ttdb.utils import run_concurrently
+
+        results = []
+        run_concurrently([lambda i=i: results.append(i) for i in range(10)], max_workers=3)
+        self.assertEqual(sorted(results), list(range(10)))
+
+    def test_error(self):
+        """Test an error in a task is raised."""
+        from ttdb.utils import run_concurrently
+
+        def fail():
+            raise ValueError()
+        self.assertRaises(ValueError, run_concurrently, [fail])
+
+
+class TestMySQLResetBackend(unittest.TestCase):
+
+    """Test copying the tables of a mysql template database."""
+
+    def setUp(self):
+        """Create a backend with a mocked connection."""
+        from ttdb.backends.mysql import MySQLResetBackend
+
+        connection = mock.Mock()
+        connection.ops.quote_name = lambda name: '`%s`' % name
+        self.backend = MySQLResetBackend(connection)
+        self.backend.workers = 1
+        self.cursor = mock.MagicMock()
+        new_connection = mock.MagicMock()
+        new_connection.cursor.return_value.__enter__.return_value = self.cursor
+        self.backend.new_connection = mock.Mock(return_value=new_connection)
+
+    def executed(self):
+        """Return the sql statements executed by the backend."""
+        return [call[0][0] for call in self.cursor.execute.call_args_list]
+
+    def test_get_tables(self):
+        """Test the tables are returned with their next auto increment values."""
+        self.cursor.fetchall.return_value = [('a', 5), ('b', None)]
+        self.assertEqual(self.backend.get_tables('template'), {'a': 5, 'b': None})
+        self.assertEqual(self.cursor.execute.call_args[0][1], ['template'])
+
+    def test_get_foreign_keys(self):
+        """Test the columns of a foreign key are grouped."""
+        self.cursor.fetchall.return_value = [
+            ('b', 'b_fk', 'x', 'a', 'id', 'CASCADE', 'RESTRICT'),
+            ('b', 'b_fk', 'y', 'a', 'id2', 'CASCADE', 'RESTRICT'),
+        ]
+        self.assertEqual(self.backend.get_foreign_keys('template'), {
+            'b': [('b_fk', ['x', 'y'], 'a', ['id', 'id2'], 'CASCADE', 'RESTRICT')],
+        })
+
+    def test_copy_tables(self):
+        """Test tables are created, filled and get their foreign keys back."""
+        self.backend.foreign_keys = {
+            'b': [('b_fk', ['a_id'], 'a', ['id'], 'NO ACTION', 'CASCADE')],
+        }
+        self.backend.copy_tables('cache', 'test', {'a': 3, 'b': None}, create=True)
+        statements = self.executed()
+        self.assertIn('CREATE TABLE `test`.`a` LIKE `cache`.`a`', statements)
+        self.assertIn('INSERT INTO `test`.`b` SELECT * FROM `cache`.`b`', statements)
+        self.assertIn('ALTER TABLE `test`.`a` AUTO_INCREMENT = 3', statements)
+        self.assertEqual(
+            statements[-1],
+            'ALTER TABLE `test`.`b` ADD CONSTRAINT `b_fk` FOREIGN KEY (`a_id`) '
+            'REFERENCES `test`.`a` (`id`) ON UPDATE NO ACTION ON DELETE CASCADE')
+
+    def test_add_referencing_tables(self):
+        """Test tables changed by cascading foreign keys are copied as well."""
+        self.backend.foreign_keys = {
+            'b': [('b_fk', ['a_id'], 'a', ['id'], 'NO ACTION', 'CASCADE')],
+            'c': [('c_fk', ['b_id'], 'b', ['id'], 'NO ACTION', 'SET NULL')],
+            'd': [('d_fk', ['a_id'], 'a', ['id'], 'RESTRICT', 'NO ACTION')],
+        }
+        self.assertEqual(self.backend.add_referencing_tables(['a']), set(['a', 'b', 'c']))
+        self.assertEqual(self.backend.add_referencing_tables(['c']), set(['c']))
+
+    @mock.patch('ttdb.backends.mysql.get_tracked_tables')
+    def test_reset_modified_tables(self, tracked_tables):
+        """Test a reset copies the modified tables and the tables referencing them."""
+        tracked_tables.return_value = set(['`a`'])
+        self.backend.cache_name = 'cache'
+        self.backend.test_database_name = 'test'
+        self.backend.tables = {'a': 3, 'b': None, 'c': None}
+        self.backend.foreign_keys = {
+            'b': [('b_fk', ['a_id'], 'a', ['id'], 'NO ACTION', 'CASCADE')],
+        }
+        self.backend.reset()
+        statements = self.executed()
+        self.assertIn('TRUNCATE TABLE `test`.`a`', statements)
+        self.assertIn('TRUNCATE TABLE `test`.`b`', statements)
+        self.assertNotIn('TRUNCATE TABLE `test`.`c`', statements)
+
+    def test_copy_modified_tables(self):
+        """Test existing tables are truncated and their foreign keys are kept."""
+        self.backend.foreign_keys = {
+            'b': [('b_fk', ['a_id'], 'a', ['id'], 'NO ACTION', 'CASCADE')],
+        }
+        self.backend.copy_tables('cache', 'test', {'b': None})
+        statements = self.executed()
+        self.assertIn('TRUNCATE TABLE `test`.`b`', statements)
+        self.assertFalse([sql for sql in statements if 'CONSTRAINT' in sql])
+
+
+class TestSQLiteTemplate(unittest.TestCase):
+
+    """Test copying a sqlite template database."""
+
+    def test_copy_sqlite_database(self):
+        """Test the target is replaced with a copy of the source."""
+        import sqlite3
+        from ttdb.backends.sqlite import copy_sqlite_database
+
+        source = sqlite3.connect(':memory:')
+        source.executescript('CREATE TABLE a (x int); INSERT INTO a VALUES (1);')
+        target = sqlite3.connect(':memory:')
+        target.executescript('CREATE TABLE a (x int); INSERT INTO a VALUES (2);')
+
+        copy_sqlite_database(source, target)
+        self.assertEqual(target.execute('SELECT x FROM a').fetchall(), [(1,)])
+
+    def test_is_in_memory_db(self):
+        """Test in memory databases are detected on every django version."""
+        from ttdb.backends.sqlite import is_in_memory_db
+
+        connection = mock.Mock()
+        connection.creation.is_in_memory_db.return_value = True
+        self.assertTrue(is_in_memory_db(connection, ':memory:'))
+        connection.creation.is_in_memory_db.assert_called_once_with(':memory:')
+
+        connection = mock.Mock()
+        connection.creation = mock.Mock(spec=[])
+        connection.is_in_memory_db.return_value = False
+        self.assertFalse(is_in_memory_db(connection, 'test.sqlite3'))
+        connection.is_in_memory_db.assert_called_once_with('test.sqlite3')
+
+
+@use_template_database('development', isolation='savepoint')
+class TestSavepointIsolation(TransactionTestCase):
+
+    """Test isolating a TransactionTestCase with an atomic block."""
+
+    @mock.patch('ttdb.utils.schedule_template_database_reload')
+    def test_no_reload(self, reload_template_database):
+        """Test changes are rolled back instead of reloading the database."""
+        from django.db import connections
+
+        TestModel.objects.all().delete()
+        self.assertEqual(TestModel.objects.count(), 0)
+        self.assertTrue(connections['default'].in_atomic_block)
+
+        self._post_teardown()
+        self._pre_setup()
+        self.assertEqual(reload_template_database.call_count, 0)
+        self.assertEqual(TestModel.objects.count(), 4)
+
+    @unittest.skipUnless(hasattr(transaction, 'on_commit'), 'on_commit needs Django 1.9')
+    def test_on_commit_outside_atomic(self):
+        """Test on_commit callbacks run right away outside of atomic blocks."""
+        callback = mock.Mock()
+        transaction.on_commit(callback)
+        self.assertEqual(callback.call_count, 1)
+
+    @unittest.skipUnless(hasattr(transaction, 'on_commit'), 'on_commit needs Django 1.9')
+    def test_on_commit_atomic(self):
+        """Test on_commit callbacks run when the outermost atomic block exits."""
+        callback = mock.Mock()
+        with transaction.atomic():
+            with transaction.atomic():
+                transaction.on_commit(callback)
+            self.assertEqual(callback.call_count, 0)
+        self.assertEqual(callback.call_count, 1)
+
+    @unittest.skipUnless(hasattr(transaction, 'on_commit'), 'on_commit needs Django 1.9')
+    def test_on_commit_rolled_back(self):
+        """Test on_commit callbacks of rolled back atomic blocks are discarded."""
+        callback = mock.Mock()
+        try:
+            with transaction.atomic():
+                transaction.on_commit(callback)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(callback.call_count, 0)
+
+    @unittest.skipUnless(hasattr(transaction, 'on_commit'), 'on_commit needs Django 1.9')
+    def test_on_commit_discarded(self):
+        """Test on_commit callbacks of atomic blocks still open are discarded."""
+        callback = mock.Mock()
+        atomic = transaction.atomic()
+        atomic.__enter__()
+        transaction.on_commit(callback)
+
+        self._post_teardown()
+        self._pre_setup()
+        self.assertEqual(callback.call_count, 0)
+
+
+class TestMethodSavepointIsolation(TemplateDBTransactionTestCase):
+
+    """Test isolating a decorated method of a template test case with an atomic block."""
+
+    template_database = 'development'
+
+    @use_template_database('development', isolation='savepoint')
+    @mock.patch('ttdb.utils.schedule_template_database_reload')
+    def test_method_isolation(self, reload_template_database):
+        """Test the isolation of the method applies instead of the class."""
+        from django.db import connections
+
+        TestModel.objects.all().delete()
+        self.assertTrue(connections['default'].in_atomic_block)
+
+        self._post_teardown()
+        self._pre_setup()
+        self.assertEqual(reload_template_database.call_count, 0)
+        self.assertEqual(TestModel.objects.count(), 4)
+
+
 @use_template_database('development')
 class TestTestCaseDecorator(TestCase):
 
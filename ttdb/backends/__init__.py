@@ -0,0 +1 @@
+"""Reset backends for template test databases."""
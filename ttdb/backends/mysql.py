@@ -0,0 +1,232 @@
+"""Reset backend that copies the tables of a MySQL or MariaDB template database."""
+
+from __future__ import absolute_import
+
+import functools
+
+from ttdb.tracking import get_tracked_tables
+from ttdb.utils import ResetBackend
+from ttdb.utils import get_template_option
+from ttdb.utils import run_concurrently
+
+
+TABLES_SQL = """
+    SELECT table_name, auto_increment
+    FROM information_schema.tables
+    WHERE table_schema = %s AND table_type = 'BASE TABLE'
+"""
+
+FOREIGN_KEYS_SQL = """
+    SELECT k.table_name, k.constraint_name, k.column_name,
+           k.referenced_table_name, k.referenced_column_name,
+           r.update_rule, r.delete_rule
+    FROM information_schema.key_column_usage k
+    JOIN information_schema.referential_constraints r
+      ON r.constraint_schema = k.constraint_schema
+     AND r.constraint_name = k.constraint_name
+     AND r.table_name = k.table_name
+    WHERE k.table_schema = %s AND k.referenced_table_schema = k.table_schema
+    ORDER BY k.table_name, k.constraint_name, k.ordinal_position
+"""
+
+
+class MySQLResetBackend(ResetBackend):
+
+    """Build the test database from a template database on the same server.
+
+    MySQL has no template databases, so on setup every table of the template
+    database (ORIGINAL_NAME) is copied into a cache database with
+    ``CREATE TABLE ... LIKE`` and ``INSERT ... SELECT``, and from there into
+    the test database. A reset copies the modified tables from the cache
+    again, or every table if the modifications are unknown (for example after
+    DDL), so the template database is only read once. Tables are copied in
+    parallel by WORKERS threads (4 by default).
+
+    ``CREATE TABLE ... LIKE`` does not copy foreign keys, so they are added
+    again once every table of a database has been created. This backend is
+    used by default for mysql template databases. Views, triggers and
+    routines are not copied.
+
+    """
+
+    def setup(self):
+        """Copy the template into the cache and the test database."""
+        self.source_name = self.connection.settings_dict['ORIGINAL_NAME']
+        self.test_database_name = self.connection.settings_dict['NAME']
+        self.cache_name = '%s_cache' % self.test_database_name
+        self.workers = get_template_option(self.connection.alias, 'WORKERS', 4)
+
+        self.execute('DROP DATABASE IF EXISTS %s' % self.quote(self.cache_name))
+        self.execute('CREATE DATABASE %s' % self.quote(self.cache_name))
+        self.tables = self.get_tables(self.source_name)
+        self.foreign_keys = self.get_foreign_keys(self.source_name)
+        self.copy_tables(self.source_name, self.cache_name, self.tables, create=True)
+        self.copy_tables(self.cache_name, self.test_database_name, self.tables, create=True)
+
+    def reset(self):
+        """Copy the modified tables from the cache into the test database."""
+        modified = get_tracked_tables(self.connection)
+        self.connection.close()
+
+        if modified is None:
+            self.execute('DROP DATABASE IF EXISTS %s' % self.quote(self.test_database_name))
+            self.execute('CREATE DATABASE %s' % self.quote(self.test_database_name))
+            self.copy_tables(self.cache_name, self.test_database_name, self.tables, create=True)
+        else:
+            names = self.add_referencing_tables(
+                set(table.split('.')[-1].strip('`"') for table in modified))
+            self.copy_tables(
+                self.cache_name, self.test_database_name,
+                dict((name, self.tables[name]) for name in names if name in self.tables))
+        return True
+
+    def teardown(self):
+        """Drop the cache database."""
+        self.execute('DROP DATABASE IF EXISTS %s' % self.quote(self.cache_name))
+
+    def get_tables(self, database_name):
+        """Return the tables of a database and their next auto increment values."""
+        connection = self.new_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(TABLES_SQL, [database_name])
+                return dict(cursor.fetchall())
+        finally:
+            connection.close()
+
+    def get_foreign_keys(self, database_name):
+        """Return the foreign keys of a database by table.
+
+        Every foreign key is a tuple of the constraint name, the columns, the
+        referenced table, the referenced columns and the update and delete
+        rules. Foreign keys referencing other databases are left out.
+
+        """
+        foreign_keys = {}
+        connection = self.new_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(FOREIGN_KEYS_SQL, [database_name])
+                for (table, name, column, referenced_table, referenced_column,
+                     update_rule, delete_rule) in cursor.fetchall():
+                    keys = foreign_keys.setdefault(table, [])
+                    if not keys or keys[-1][0] != name:
+                        keys.append((name, [], referenced_table, [], update_rule, delete_rule))
+                    keys[-1][1].append(column)
+                    keys[-1][3].append(referenced_column)
+        finally:
+            connection.close()
+        return foreign_keys
+
+    def add_referencing_tables(self, names):
+        """Add the tables that writes to the tables in names may change.
+
+        Foreign keys with a rule other than RESTRICT or NO ACTION change the
+        rows of the referencing table when a referenced row is updated or
+        deleted, which in turn may change the tables referencing it.
+
+        """
+        names = set(names)
+        changed = list(names)
+        while changed:
+            referenced = changed.pop()
+            for table, keys in self.foreign_keys.items():
+                if table in names:
+                    continue
+                for (name, columns, referenced_table, referenced_columns,
+                     update_rule, delete_rule) in keys:
+                    if referenced_table == referenced and (
+                            update_rule not in ('RESTRICT', 'NO ACTION') or
+                            delete_rule not in ('RESTRICT', 'NO ACTION')):
+                        names.add(table)
+                        changed.append(table)
+                        break
+        return names
+
+    def copy_tables(self, source_name, target_name, tables, create=False):
+        """Copy the tables from one database to another in parallel.
+
+        If the tables are created their foreign keys are added afterwards.
+
+        """
+        names = sorted(tables)
+        tasks = [
+            functools.partial(
+                self.copy_table_group, source_name, target_name,
+                dict((name, tables[name]) for name in names[i::self.workers]), create)
+            for i in range(self.workers)]
+        run_concurrently(tasks)
+        if create:
+            self.add_foreign_keys(target_name, tables)
+
+    def add_foreign_keys(self, database_name, tables):
+        """Add the foreign keys of the template to the tables of a database."""
+        connection = self.new_connection()
+        try:
+            with connection.cursor() as cursor:
+                # The rows were copied from the template, so they are valid.
+                cursor.execute('SET FOREIGN_KEY_CHECKS = 0')
+                for table in sorted(tables):
+                    constraints = [
+                        'ADD CONSTRAINT %s FOREIGN KEY (%s) REFERENCES %s.%s (%s) '
+                        'ON UPDATE %s ON DELETE %s' % (
+                            self.quote(name),
+                            ', '.join(self.quote(column) for column in columns),
+                            self.quote(database_name), self.quote(referenced_table),
+                            ', '.join(self.quote(column) for column in referenced_columns),
+                            update_rule, delete_rule)
+                        for (name, columns, referenced_table, referenced_columns,
+                             update_rule, delete_rule) in self.foreign_keys.get(table, [])]
+                    if constraints:
+                        cursor.execute('ALTER TABLE %s.%s %s' % (
+                            self.quote(database_name), self.quote(table),
+                            ', '.join(constraints)))
+        finally:
+            connection.close()
+
+    def copy_table_group(self, source_name, target_name, tables, create):
+        """Copy a group of tables using a single connection."""
+        if not tables:
+            return
+        connection = self.new_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SET FOREIGN_KEY_CHECKS = 0')
+                cursor.execute('SET UNIQUE_CHECKS = 0')
+                for name, auto_increment in sorted(tables.items()):
+                    source = '%s.%s' % (self.quote(source_name), self.quote(name))
+                    target = '%s.%s' % (self.quote(target_name), self.quote(name))
+                    if create:
+                        cursor.execute('CREATE TABLE %s LIKE %s' % (target, source))
+                    else:
+                        cursor.execute('TRUNCATE TABLE %s' % target)
+                    cursor.execute('INSERT INTO %s SELECT * FROM %s' % (target, source))
+                    if auto_increment:
+                        cursor.execute('ALTER TABLE %s AUTO_INCREMENT = %d' % (
+                            target, auto_increment))
+        finally:
+            connection.close()
+
+    def execute(self, sql):
+        """Execute sql using a new connection."""
+        connection = self.new_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(sql)
+        finally:
+            connection.close()
+
+    def new_connection(self):
+        """Return a new, untracked connection to the template database.
+
+        The template database is used because the test database is dropped
+        and created again by a full reset.
+
+        """
+        settings_dict = self.connection.settings_dict.copy()
+        settings_dict['NAME'] = settings_dict['ORIGINAL_NAME']
+        return self.connection.__class__(settings_dict, alias=self.connection.alias)
+
+    def quote(self, name):
+        """Quote a database or table name."""
+        return self.connection.ops.quote_name(name)
@@ -0,0 +1,160 @@
+"""Reset backend that restores a filesystem snapshot of a local postgres cluster."""
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+
+from ttdb.utils import ResetBackend
+from ttdb.utils import get_template_option
+
+
+class SnapshotResetBackend(ResetBackend):
+
+    """Run the template test database in a disposable local postgres cluster.
+
+    On setup a new cluster is initialised in a temporary directory, the test
+    database is copied into it with pg_dump and pg_restore and the stopped
+    cluster is snapshotted. The connection is then pointed at the cluster. A
+    reset stops the postmaster, replaces the data directory with a copy of the
+    snapshot and starts the postmaster again, so it takes about as long as a
+    restart when the copy is copy-on-write.
+
+    Options (set through TTDB_OPTIONS or TTDB_<OPTION>):
+
+    * SNAPSHOT_DIR: directory the cluster is created in. Use a filesystem that
+      supports reflinks (btrfs, xfs) or btrfs subvolumes for fast resets.
+    * SNAPSHOT_METHOD: 'reflink' (the default) copies with
+      ``cp --reflink=auto``, falling back to a plain copy, 'btrfs' uses btrfs
+      subvolume snapshots.
+    * PG_BIN: directory containing initdb, pg_ctl, createdb, pg_dump and
+      pg_restore.
+
+    """
+
+    def setup(self):
+        """Create the cluster, load the test database and snapshot it."""
+        self.method = get_template_option(self.connection.alias, 'SNAPSHOT_METHOD', 'reflink')
+        self.bin_dir = get_template_option(self.connection.alias, 'PG_BIN', '')
+        self.root = tempfile.mkdtemp(
+            prefix='ttdb-', dir=get_template_option(self.connection.alias, 'SNAPSHOT_DIR'))
+        self.snapshot_dir = os.path.join(self.root, 'snapshot')
+        self.data_dir = os.path.join(self.root, 'data')
+        self.port = self.get_free_port()
+        self.old_settings = dict(
+            (key, self.connection.settings_dict.get(key))
+            for key in ('HOST', 'PORT', 'USER', 'PASSWORD'))
+
+        if self.method == 'btrfs':
+            self.run('btrfs', 'subvolume', 'create', self.snapshot_dir)
+        self.run(self.bin('initdb'), '-D', self.snapshot_dir, '-U', 'postgres',
+                 '--auth=trust', '--no-sync')
+        self.start(self.snapshot_dir)
+        try:
+            self.load_test_database()
+        finally:
+            self.stop(self.snapshot_dir, mode='fast')
+
+        self.copy_snapshot()
+        self.start(self.data_dir)
+
+        self.connection.close()
+        self.connection.settings_dict.update({
+            'HOST': self.root,
+            'PORT': str(self.port),
+            'USER': 'postgres',
+            'PASSWORD': '',
+        })
+
+    def reset(self):
+        """Restore the snapshot and restart the postmaster."""
+        self.connection.close()
+        self.stop(self.data_dir, mode='immediate')
+        self.remove(self.data_dir)
+        self.copy_snapshot()
+        self.start(self.data_dir)
+        return True
+
+    def teardown(self):
+        """Stop the cluster, remove it and point the connection back at the server."""
+        self.connection.close()
+        self.connection.settings_dict.update(self.old_settings)
+        self.stop(self.data_dir, mode='immediate')
+        self.remove(self.data_dir)
+        self.remove(self.snapshot_dir)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def load_test_database(self):
+        """Copy the test database from the server into the cluster."""
+        name = self.connection.settings_dict['NAME']
+        dump = os.path.join(self.root, 'dump')
+        env = dict(os.environ)
+        if self.old_settings['PASSWORD']:
+            env['PGPASSWORD'] = self.old_settings['PASSWORD']
+
+        args = [self.bin('pg_dump'), '--format=custom', '--file', dump]
+        if self.old_settings['HOST']:
+            args += ['--host', self.old_settings['HOST']]
+        if self.old_settings['PORT']:
+            args += ['--port', str(self.old_settings['PORT'])]
+        if self.old_settings['USER']:
+            args += ['--username', self.old_settings['USER']]
+        self.run(*(args + [name]), env=env)
+
+        self.run(self.bin('createdb'), '--host', self.root, '--port', str(self.port),
+                 '--username', 'postgres', name)
+        self.run(self.bin('pg_restore'), '--host', self.root, '--port', str(self.port),
+                 '--username', 'postgres', '--no-owner', '--dbname', name, dump)
+        os.remove(dump)
+
+    def copy_snapshot(self):
+        """Make the data directory a copy of the snapshot."""
+        if self.method == 'btrfs':
+            self.run('btrfs', 'subvolume', 'snapshot', self.snapshot_dir, self.data_dir)
+            return
+        try:
+            self.run('cp', '-a', '--reflink=auto', self.snapshot_dir, self.data_dir)
+        except (OSError, subprocess.CalledProcessError):
+            self.remove(self.data_dir)
+            shutil.copytree(self.snapshot_dir, self.data_dir, symlinks=True)
+
+    def remove(self, path):
+        """Remove a data directory."""
+        if not os.path.exists(path):
+            return
+        if self.method == 'btrfs':
+            self.run('btrfs', 'subvolume', 'delete', path)
+        else:
+            shutil.rmtree(path)
+
+    def start(self, data_dir):
+        """Start the postmaster and wait until it accepts connections."""
+        options = "-p %d -k %s -c listen_addresses='' -c fsync=off" % (self.port, self.root)
+        self.run(self.bin('pg_ctl'), '-D', data_dir, '-o', options, '-w',
+                 '-l', os.path.join(self.root, 'postgres.log'), 'start')
+
+    def stop(self, data_dir, mode):
+        """Stop the postmaster if it is running."""
+        if os.path.exists(os.path.join(data_dir, 'postmaster.pid')):
+            self.run(self.bin('pg_ctl'), '-D', data_dir, '-m', mode, '-w', 'stop')
+
+    def bin(self, name):
+        """Return the path of a postgres program."""
+        return os.path.join(self.bin_dir, name) if self.bin_dir else name
+
+    def run(self, *args, **kwargs):
+        """Run a program and raise an exception if it fails."""
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(args, stdout=devnull, **kwargs)
+
+    def get_free_port(self):
+        """Return a port number nothing is listening on."""
+        sock = socket.socket()
+        try:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+        finally:
+            sock.close()
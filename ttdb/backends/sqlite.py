@@ -0,0 +1,74 @@
+"""Reset backend that copies a prepared sqlite database file."""
+
+from __future__ import absolute_import
+
+import shutil
+import sqlite3
+
+from ttdb.utils import ResetBackend
+
+
+def copy_sqlite_database(source, target):
+    """Copy the sqlite database source into the open connection target.
+
+    Uses the online backup API when it is available (python 3.7 and above),
+    otherwise the tables of target are dropped and the sql dump of source is
+    executed against it.
+
+    """
+    if hasattr(source, 'backup'):
+        source.backup(target)
+        return
+
+    cursor = target.cursor()
+    cursor.execute('PRAGMA foreign_keys = OFF')
+    cursor.execute(
+        "SELECT type, name FROM sqlite_master "
+        "WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%'")
+    for kind, name in cursor.fetchall():
+        cursor.execute('DROP %s IF EXISTS "%s"' % (kind.upper(), name.replace('"', '""')))
+    target.executescript('\n'.join(source.iterdump()))
+
+
+def is_in_memory_db(connection, name):
+    """Return True if the sqlite database name is an in memory database."""
+    if hasattr(connection.creation, 'is_in_memory_db'):
+        return connection.creation.is_in_memory_db(name)
+    # django < 2.0
+    return connection.is_in_memory_db(name)
+
+
+class SQLiteResetBackend(ResetBackend):
+
+    """Use a prepared sqlite database file as the template database.
+
+    The NAME of the database is the template file. Django creates an empty
+    test database as usual (in memory unless the TEST NAME is set) and the
+    backend copies the template into it, with the sqlite online backup API
+    for an in memory test database or by copying the file otherwise. A reset
+    copies the template again, so it never runs any migrations or fixtures.
+
+    This backend is used by default for sqlite template databases.
+
+    """
+
+    def setup(self):
+        """Copy the template into the new test database."""
+        self.reset()
+
+    def reset(self):
+        """Replace the test database with a copy of the template."""
+        template = self.connection.settings_dict['ORIGINAL_NAME']
+        test_database_name = self.connection.settings_dict['NAME']
+        if not is_in_memory_db(self.connection, test_database_name):
+            self.connection.close()
+            shutil.copyfile(template, test_database_name)
+            return True
+
+        self.connection.ensure_connection()
+        source = sqlite3.connect(template)
+        try:
+            copy_sqlite_database(source, self.connection.connection)
+        finally:
+            source.close()
+        return True
@@ -0,0 +1,296 @@
+"""Build template databases from migrations and data files."""
+
+import copy
+import functools
+import hashlib
+import inspect
+import os
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from ttdb.fingerprint import get_database_fingerprint
+from ttdb.fingerprint import get_template_fingerprint
+from ttdb.fingerprint import set_database_fingerprint
+from ttdb.timing import timed
+from ttdb.utils import create_database_from_template
+from ttdb.utils import get_template_option
+from ttdb.utils import run_concurrently
+
+
+STEPS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS ttdb_build_steps (
+        step text PRIMARY KEY,
+        hash text NOT NULL
+    )
+"""
+
+MIGRATIONS_SQL = """
+    SELECT app, name FROM django_migrations ORDER BY app, name
+"""
+
+FOREIGN_KEYS_SQL = """
+    SELECT t.relname, r.relname
+    FROM pg_constraint c
+    JOIN pg_class t ON t.oid = c.conrelid
+    JOIN pg_class r ON r.oid = c.confrelid
+    WHERE c.contype = 'f'
+"""
+
+
+def get_step_kind(step):
+    """Return 'sql', 'csv' or 'callable' depending on how a step is loaded."""
+    extension = os.path.splitext(step)[1].lower()
+    if extension in ('.sql', '.csv'):
+        return extension[1:]
+    return 'callable'
+
+
+def get_step_hash(step):
+    """Return a hash of the inputs of a build step.
+
+    The hash of a file covers its content, the hash of a callable covers the
+    source of the module that defines it.
+
+    """
+    if get_step_kind(step) == 'callable':
+        source = inspect.getsource(inspect.getmodule(import_string(step)))
+        content = source.encode('utf-8')
+    else:
+        with open(step, 'rb') as f:
+            content = f.read()
+    return hashlib.sha1(content).hexdigest()
+
+
+def get_step_table(step):
+    """Return the table a csv file is loaded into, named after the file."""
+    return os.path.splitext(os.path.basename(step))[0]
+
+
+def run_steps(alias, steps):
+    """Load build steps into the template database.
+
+    sql files are executed, csv files (with a header row) are copied into the
+    table they are named after and callables are called with the connection.
+    The steps run in one transaction, in the connection of the current
+    thread, which is closed afterwards. Tables are not truncated before a csv
+    file is copied into them, see load_steps.
+
+    """
+    from django.db import connections
+
+    connection = connections[alias]
+    try:
+        with timed('load', alias):
+            with transaction.atomic(using=alias):
+                with connection.cursor() as cursor:
+                    for step in steps:
+                        kind = get_step_kind(step)
+                        if kind == 'sql':
+                            with open(step) as f:
+                                cursor.execute(f.read())
+                        elif kind == 'csv':
+                            table = connection.ops.quote_name(get_step_table(step))
+                            with open(step) as f:
+                                cursor.copy_expert(
+                                    'COPY %s FROM STDIN (FORMAT csv, HEADER true)' % table, f)
+                        else:
+                            import_string(step)(connection)
+    finally:
+        connection.close()
+
+
+def get_referencing_tables(foreign_keys, tables):
+    """Return the tables and every table referencing them, directly or indirectly."""
+    found = set(tables)
+    added = True
+    while added:
+        added = False
+        for table, referenced in foreign_keys:
+            if referenced in found and table not in found:
+                found.add(table)
+                added = True
+    return found
+
+
+def get_load_order(foreign_keys, tables):
+    """Order tables so every table is loaded after the tables it references.
+
+    Returns a list of levels, each a list of groups of tables. The groups of
+    a level only reference the tables of earlier levels, so they can be
+    loaded at the same time. Tables referencing each other in a cycle form a
+    single group, which has to be loaded in one transaction.
+
+    """
+    tables = set(tables)
+    references = dict((table, set()) for table in tables)
+    for table, referenced in foreign_keys:
+        if table in tables and referenced in tables and table != referenced:
+            references[table].add(referenced)
+
+    levels = []
+    loaded = set()
+    while loaded != tables:
+        level = sorted(table for table in tables - loaded if references[table] <= loaded)
+        if level:
+            levels.append([[table] for table in level])
+        else:
+            level = sorted(tables - loaded)
+            levels.append([level])
+        loaded.update(level)
+    return levels
+
+
+def load_steps(alias, steps, workers=1, stdout=None):
+    """Load build steps into the template database.
+
+    Consecutive csv files are loaded together: their tables, and the tables
+    referencing them, are truncated in a single statement first. Then the
+    csv files are copied into their tables in the order of the foreign keys
+    between them, by at most workers threads at the same time. The other
+    steps are run one at a time. Progress is written to stdout if given.
+
+    """
+    from django.db import connections
+
+    connection = connections[alias]
+    index = 0
+    while index < len(steps):
+        group = steps[index:index + 1]
+        while (get_step_kind(group[0]) == 'csv' and index + len(group) < len(steps) and
+               get_step_kind(steps[index + len(group)]) == 'csv'):
+            group.append(steps[index + len(group)])
+        index += len(group)
+        if stdout is not None:
+            for step in group:
+                stdout.write('Loading %s into %s' % (step, alias))
+        if get_step_kind(group[0]) != 'csv':
+            run_steps(alias, group)
+            continue
+
+        files = dict((get_step_table(step), step) for step in group)
+        try:
+            with transaction.atomic(using=alias):
+                with connection.cursor() as cursor:
+                    cursor.execute(FOREIGN_KEYS_SQL)
+                    foreign_keys = cursor.fetchall()
+                    cursor.execute('TRUNCATE %s' % ', '.join(
+                        connection.ops.quote_name(table)
+                        for table in sorted(get_referencing_tables(foreign_keys, files))))
+        finally:
+            connection.close()
+        for level in get_load_order(foreign_keys, files):
+            run_concurrently([
+                functools.partial(run_steps, alias, [files[table] for table in tables])
+                for tables in level], workers)
+
+
+def build_template_database(alias, force=False, stdout=None):
+    """Migrate a template database and load its BUILD_STEPS into it.
+
+    BUILD_STEPS is a list of sql files, csv files and dotted paths to
+    callables, in the order they are loaded (see load_steps). Only the first
+    step whose inputs changed since the last build and the steps after it run
+    again, because loading a csv file truncates the tables referencing its
+    table. Every step runs if force is True or a migration was applied.
+    Consecutive csv files are loaded concurrently by WORKERS threads (4 by
+    default). Returns the steps that were run.
+
+    """
+    from django.db import connections
+
+    connection = connections[alias]
+    steps = list(get_template_option(alias, 'BUILD_STEPS', ()))
+    workers = get_template_option(alias, 'WORKERS', 4)
+
+    call_command('migrate', database=alias, interactive=False, verbosity=0)
+    with connection.cursor() as cursor:
+        cursor.execute(STEPS_TABLE_SQL)
+        cursor.execute('SELECT step, hash FROM ttdb_build_steps')
+        old_hashes = dict(cursor.fetchall())
+        cursor.execute(MIGRATIONS_SQL)
+        migrations = repr(cursor.fetchall()).encode('utf-8')
+
+    hashes = dict((step, get_step_hash(step)) for step in steps)
+    hashes['migrations'] = hashlib.sha1(migrations).hexdigest()
+    if force or old_hashes.get('migrations') != hashes['migrations']:
+        pending = steps
+    else:
+        changed = [index for index, step in enumerate(steps)
+                   if old_hashes.get(step) != hashes[step]]
+        pending = steps[changed[0]:] if changed else []
+
+    with connection.cursor() as cursor:
+        # Forget the steps that are about to run, in case loading fails.
+        cursor.execute('DELETE FROM ttdb_build_steps')
+    connection.close()
+
+    load_steps(alias, pending, workers, stdout)
+
+    with connection.cursor() as cursor:
+        for step, step_hash in sorted(hashes.items()):
+            cursor.execute(
+                'INSERT INTO ttdb_build_steps (step, hash) VALUES (%s, %s)',
+                [step, step_hash])
+    connection.close()
+    return pending
+
+
+def get_layer_settings(alias):
+    """Return the database settings of a layered template alias.
+
+    A layered alias ('base+scenario') uses the settings of the base alias with
+    '_scenario' appended to the database names. The base alias has to be a
+    template database itself.
+
+    """
+    from django.db import connections
+
+    base, scenario = alias.split('+', 1)
+    if base not in settings.TTDB or base not in connections.databases:
+        raise ImproperlyConfigured(
+            '%s: the base template database %s must be listed in TTDB.' % (alias, base))
+    settings_dict = copy.deepcopy(connections.databases[base])
+    settings_dict.pop('ORIGINAL_NAME', None)
+    settings_dict['NAME'] = '%s_%s' % (settings_dict['NAME'], scenario)
+    test_settings = settings_dict.get('TEST', {})
+    if test_settings.get('NAME'):
+        test_settings['NAME'] = '%s_%s' % (test_settings['NAME'], scenario)
+    return settings_dict
+
+
+def build_layer(alias):
+    """Create the template database of a layered alias if it is out of date.
+
+    The template database of the base alias is copied and the DELTA steps of
+    the layered alias (see build_template_database) are loaded into the copy.
+    The copy is kept for later runs and only built again when the base
+    template or one of the steps changed. Returns True if it was built.
+
+    """
+    from django.db import connections
+
+    base_alias = alias.split('+', 1)[0]
+    if base_alias not in settings.TTDB:
+        raise ImproperlyConfigured(
+            '%s: the base template database %s must be listed in TTDB.' % (alias, base_alias))
+    base = connections[base_alias]
+    if base.vendor != 'postgresql':
+        raise ImproperlyConfigured('%s: layered template databases need postgres.' % alias)
+    name = connections[alias].settings_dict['ORIGINAL_NAME']
+    steps = get_template_option(alias, 'DELTA', ())
+
+    fingerprint = hashlib.sha1(get_template_fingerprint(base).encode('utf-8'))
+    for step in steps:
+        fingerprint.update(get_step_hash(step).encode('utf-8'))
+    fingerprint = fingerprint.hexdigest()
+    if get_database_fingerprint(base, name) == fingerprint:
+        return False
+
+    create_database_from_template(base, name, prepare=False)
+    load_steps(alias, list(steps), get_template_option(alias, 'WORKERS', 4))
+    set_database_fingerprint(base, name, fingerprint)
+    return True
@@ -0,0 +1,220 @@
+"""Serve reference data of read only template tests from a cached snapshot."""
+
+import hashlib
+import os
+import pickle
+import stat
+import tempfile
+
+from django.apps import apps
+
+from ttdb.fingerprint import get_template_fingerprint
+from ttdb.incremental import get_source_connection
+from ttdb.routing import get_routed_alias
+from ttdb.utils import get_template_option
+
+
+# Reference data of each template database, loaded once per process.
+_snapshots = {}
+
+# Aliases of the template databases whose reference data is served from the
+# cache, with the number of tests that enabled it.
+_enabled = {}
+
+
+def get_model_label(model):
+    """Return the lower case 'app_label.model_name' label of a model."""
+    return '%s.%s' % (model._meta.app_label, model._meta.model_name)
+
+
+def get_cache_directory():
+    """Return the directory of the snapshots, which only the current user can access.
+
+    Returns None if the directory exists but is owned by another user or can
+    be accessed by other users, because loading a snapshot runs code.
+
+    """
+    getuid = getattr(os, 'getuid', None)
+    if getuid is None:
+        # Windows gives every user a temporary directory of their own.
+        path = os.path.join(tempfile.gettempdir(), 'ttdb')
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return path
+
+    path = os.path.join(tempfile.gettempdir(), 'ttdb-%d' % getuid())
+    try:
+        os.mkdir(path, 0o700)
+    except OSError:
+        pass
+    info = os.lstat(path)
+    if (not stat.S_ISDIR(info.st_mode) or info.st_uid != getuid() or
+            info.st_mode & (stat.S_IRWXG | stat.S_IRWXO)):
+        return None
+    return path
+
+
+def get_snapshot_key(connection):
+    """Return a key that changes whenever the template database changes.
+
+    Postgres templates use their fingerprint (see get_template_fingerprint),
+    other templates the VERSION option or, for sqlite, the size and
+    modification time of the template file. Returns None if there is no way
+    to tell whether the template changed.
+
+    """
+    if connection.vendor == 'postgresql':
+        return get_template_fingerprint(connection)
+    version = get_template_option(connection.alias, 'VERSION')
+    if callable(version):
+        version = version()
+    if version is None and connection.vendor == 'sqlite':
+        name = connection.settings_dict['ORIGINAL_NAME']
+        if not os.path.isfile(name):
+            return None
+        info = os.stat(name)
+        version = (os.path.abspath(name), info.st_size, info.st_mtime)
+    if version is None:
+        return None
+    return hashlib.sha1(repr(version).encode('utf-8')).hexdigest()
+
+
+def get_snapshot_path(directory, alias, key):
+    """Return the file the reference data of a template database is stored in."""
+    return os.path.join(directory, '%s-%s.pickle' % (alias, key))
+
+
+def save_snapshot(path, snapshot):
+    """Store a snapshot and remove the outdated snapshots of the same template."""
+    directory, name = os.path.split(path)
+    handle, temp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(handle, 'wb') as f:
+        pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(temp_path, path)
+    alias = name.rsplit('-', 1)[0]
+    for old_name in os.listdir(directory):
+        if (old_name != name and old_name.endswith('.pickle') and
+                old_name.rsplit('-', 1)[0] == alias):
+            try:
+                os.remove(os.path.join(directory, old_name))
+            except OSError:
+                pass
+
+
+def load_snapshot(connection):
+    """Read the CACHED_MODELS of the template database.
+
+    Returns a dictionary mapping the label of every model to the names of its
+    concrete fields and the values of every row.
+
+    """
+    snapshot = {}
+    source = get_source_connection(connection)
+    try:
+        with source.cursor() as cursor:
+            for label in get_template_option(connection.alias, 'CACHED_MODELS', ()):
+                model = apps.get_model(label)
+                fields = [field.attname for field in model._meta.concrete_fields]
+                columns = [field.column for field in model._meta.concrete_fields]
+                cursor.execute('SELECT %s FROM %s' % (
+                    ', '.join(source.ops.quote_name(column) for column in columns),
+                    source.ops.quote_name(model._meta.db_table)))
+                snapshot[get_model_label(model)] = (fields, cursor.fetchall())
+    finally:
+        source.close()
+    return snapshot
+
+
+def get_snapshot(alias):
+    """Return the reference data of a template database.
+
+    The data is read from the template database once per process. It is
+    stored in a file in a cache directory of the current user, named after a
+    key of the template (see get_snapshot_key), so other processes (such as
+    parallel test workers started with spawn) and later runs read the file
+    instead of querying the template until it changes. The runner loads the
+    data before parallel workers are forked, so forked workers inherit it.
+
+    """
+    from django.db import connections
+
+    if alias not in _snapshots:
+        connection = connections[alias]
+        directory = get_cache_directory()
+        key = get_snapshot_key(connection) if directory is not None else None
+        if key is None:
+            _snapshots[alias] = load_snapshot(connection)
+            return _snapshots[alias]
+        path = get_snapshot_path(directory, alias, key)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                _snapshots[alias] = pickle.load(f)
+        else:
+            _snapshots[alias] = load_snapshot(connection)
+            save_snapshot(path, _snapshots[alias])
+    return _snapshots[alias]
+
+
+def enable_reference_cache(alias):
+    """Serve the reference data of a template database from the cache."""
+    get_snapshot(alias)
+    _enabled[alias] = _enabled.get(alias, 0) + 1
+
+
+def disable_reference_cache(alias):
+    """Query the template database for its reference data again."""
+    _enabled[alias] -= 1
+    if not _enabled[alias]:
+        del _enabled[alias]
+
+
+def get_cached_lookups(queryset):
+    """Return the exact lookups of a queryset as a dictionary.
+
+    Returns None if the queryset does more than filtering on exact field
+    values, such as ordering, slicing or joining.
+
+    """
+    query = queryset.query
+    if (query.order_by or query.extra or query.annotations or query.select_related or
+            query.low_mark or query.high_mark is not None or
+            query.where.negated or query.where.connector != 'AND' or
+            len(query.alias_map) > 1 or query.distinct):
+        return None
+    lookups = {}
+    for child in query.where.children:
+        target = getattr(getattr(child, 'lhs', None), 'target', None)
+        if getattr(child, 'lookup_name', None) != 'exact' or target is None:
+            return None
+        value = child.rhs
+        if hasattr(value, '_meta'):
+            value = value.pk
+        lookups[target.attname] = value
+    return lookups
+
+
+def cacheable(queryset):
+    """Return the result of a queryset, from the cache if possible.
+
+    The result is served from the cache if the template database the
+    queryset uses has the reference cache enabled, the model is in its
+    CACHED_MODELS option and the queryset only filters on exact field values.
+    Otherwise the queryset is evaluated. Returns a list of model instances.
+
+    """
+    alias = queryset.db
+    if alias == 'default':
+        alias = get_routed_alias() or alias
+    label = get_model_label(queryset.model)
+    lookups = None
+    if alias in _enabled and label in _snapshots[alias]:
+        lookups = get_cached_lookups(queryset)
+    if lookups is None:
+        return list(queryset)
+
+    fields, rows = _snapshots[alias][label]
+    if not set(lookups) <= set(fields):
+        return list(queryset)
+    indexes = [(fields.index(name), value) for name, value in lookups.items()]
+    return [queryset.model.from_db(queryset.db, fields, row) for row in rows
+            if all(row[index] == value for index, value in indexes)]
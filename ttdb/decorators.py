@@ -7,29 +7,59 @@ import functools
 from ttdb.testcases import TemplateDBTestCase 
 from ttdb.testcases import TemplateDBLiveServerTestCase
 from ttdb.testcases import TemplateDBTransactionTestCase
-from ttdb.utils import reload_template_database
+from ttdb.suite import get_template_isolation
+from ttdb.suite import get_template_scope
+from ttdb.suite import get_template_scope_key
 from ttdb.utils import restore_default_database
 from ttdb.utils import enable_template_database  
+from ttdb.utils import finish_template_test
+from ttdb.utils import start_savepoint_isolation
+from ttdb.utils import end_savepoint_isolation
+
+
+TEMPLATE_TEST_CASES = (
+    TemplateDBTestCase, TemplateDBTransactionTestCase, TemplateDBLiveServerTestCase)
 
 
 class use_template_database(object):
 
     """Decorator that switches the test database to another."""
 
-    def __init__(self, db_name, reload_after_test=True):
-        """Set args for the decorator."""
+    def __init__(self, db_name, reload_after_test=True, isolation=None, scope=None):
+        """Set args for the decorator.
+
+        isolation is 'reload' or 'savepoint'. By default test methods of a
+        TestCase are isolated with a savepoint and everything else by
+        reloading the database (see ttdb.suite.get_template_isolation). scope
+        is one of 'method', 'class', 'module' or 'session' and overrides
+        reload_after_test (see ttdb.suite.get_template_scope).
+
+        """
         self.template_database = db_name
         self.reload_after_test = reload_after_test
+        self.isolation = isolation
+        self.scope = scope
+        self.scope_key = None
+        self.test_isolation = isolation or 'reload'
 
     def __enter__(self):
         """For using in with statement."""
-        self._templatedb_patches = enable_template_database(self.template_database)
+        self._templatedb_route = enable_template_database(
+            self.template_database, scope_key=self.scope_key)
+        if self.test_isolation == 'savepoint':
+            self._templatedb_atomic = start_savepoint_isolation(self.template_database)
 
     def __exit__(self, exc_type, exc_value, traceback):
         """For using in with statement."""
-        restore_default_database(*self._templatedb_patches)
-        if self.reload_after_test is True:
-            reload_template_database(self.template_database)
+        if self.test_isolation == 'savepoint':
+            end_savepoint_isolation(
+                self.template_database, self._templatedb_atomic,
+                (exc_type, exc_value, traceback))
+            restore_default_database(self._templatedb_route)
+            return
+        restore_default_database(self._templatedb_route)
+        finish_template_test(
+            self.template_database, get_template_scope(self), self.scope_key)
 
     def __call__(self, test_func):
         """Switch the test database to the one specified.
@@ -42,6 +72,8 @@ class use_template_database(object):
         if isinstance(test_func, type) and issubclass(test_func, TransactionTestCase):
             test_func.template_database = self.template_database
             test_func.reload_after_test = self.reload_after_test
+            test_func.isolation = self.isolation
+            test_func.scope = self.scope
 
             if issubclass(test_func, TestCase):
                 test_func.__bases__ = (TemplateDBTestCase,) + test_func.__bases__
@@ -55,6 +87,20 @@ class use_template_database(object):
         # the patch.
         @functools.wraps(test_func)
         def inner(*args, **kwargs):
+            test = args[0] if args else None
+            if (isinstance(test, TEMPLATE_TEST_CASES) and
+                    test.template_database == self.template_database):
+                # The test case already switched the database and reloads it
+                # according to the options of this method.
+                return test_func(*args, **kwargs)
+            if test is not None:
+                self.scope_key = get_template_scope_key(
+                    test.__class__, get_template_scope(self))
+                self.test_isolation = get_template_isolation(inner, test)
             with self:
                 return test_func(*args, **kwargs)
+        inner.template_database = self.template_database
+        inner.reload_after_test = self.reload_after_test
+        inner.isolation = self.isolation
+        inner.scope = self.scope
         return inner 
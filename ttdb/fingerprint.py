@@ -0,0 +1,97 @@
+"""Fingerprint template databases to reuse test databases across test runs."""
+
+import hashlib
+
+from ttdb.incremental import get_source_connection
+from ttdb.utils import execute_without_database
+from ttdb.utils import get_template_option
+
+
+FINGERPRINT_PREFIX = 'ttdb:'
+
+SCHEMA_SQL = """
+    SELECT n.nspname, c.relname, c.relkind, a.attname,
+           format_type(a.atttypid, a.atttypmod)
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0
+                             AND NOT a.attisdropped
+    WHERE n.nspname NOT IN ('pg_catalog', 'information_schema')
+      AND n.nspname NOT LIKE 'pg_toast%'
+    ORDER BY 1, 2, 4
+"""
+
+MIGRATIONS_SQL = """
+    SELECT app, name FROM django_migrations ORDER BY app, name
+"""
+
+STATS_SQL = """
+    SELECT tup_inserted, tup_updated, tup_deleted, stats_reset,
+           pg_database_size(datname)
+    FROM pg_stat_database
+    WHERE datname = current_database()
+"""
+
+COMMENT_SQL = """
+    SELECT shobj_description(oid, 'pg_database')
+    FROM pg_database
+    WHERE datname = %s
+"""
+
+
+def get_template_fingerprint(connection):
+    """Return a fingerprint of the template (source) database.
+
+    The fingerprint covers the schema, the applied migrations and either the
+    VERSION option of the template database or the write statistics and size
+    of the database. VERSION may be a string or a callable returning a string.
+
+    """
+    version = get_template_option(connection.alias, 'VERSION')
+    if callable(version):
+        version = version()
+
+    fingerprint = hashlib.sha1()
+    source = get_source_connection(connection)
+    try:
+        with source.cursor() as cursor:
+            cursor.execute(SCHEMA_SQL)
+            rows = cursor.fetchall()
+            fingerprint.update(repr(rows).encode('utf-8'))
+            if ('public', 'django_migrations', 'r') in [row[:3] for row in rows]:
+                cursor.execute(MIGRATIONS_SQL)
+                fingerprint.update(repr(cursor.fetchall()).encode('utf-8'))
+            if version is None:
+                cursor.execute(STATS_SQL)
+                fingerprint.update(repr(cursor.fetchall()).encode('utf-8'))
+            else:
+                fingerprint.update(repr(version).encode('utf-8'))
+    finally:
+        source.close()
+    return fingerprint.hexdigest()
+
+
+def get_database_fingerprint(connection, name):
+    """Return the fingerprint stored on a test database, if any."""
+    nodb_connection = connection.creation._nodb_connection
+    try:
+        with nodb_connection.cursor() as cursor:
+            cursor.execute(COMMENT_SQL, [name])
+            row = cursor.fetchone()
+    finally:
+        nodb_connection.close()
+    if row is None or not row[0] or not row[0].startswith(FINGERPRINT_PREFIX):
+        return None
+    return row[0][len(FINGERPRINT_PREFIX):]
+
+
+def set_database_fingerprint(connection, name, fingerprint):
+    """Store the fingerprint of the template on a test database."""
+    execute_without_database(connection, "COMMENT ON DATABASE %s IS '%s%s'" % (
+        connection.ops.quote_name(name), FINGERPRINT_PREFIX, fingerprint))
+
+
+def clear_database_fingerprint(connection, name):
+    """Remove the fingerprint from a test database while it is in use."""
+    execute_without_database(connection, 'COMMENT ON DATABASE %s IS NULL' % (
+        connection.ops.quote_name(name)))
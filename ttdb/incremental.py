@@ -0,0 +1,169 @@
+"""Restore tables of a template test database from snapshots of the template."""
+
+import tempfile
+
+from django.db import DatabaseError
+from django.db import transaction
+
+from ttdb.tracking import get_tracked_tables
+from ttdb.tracking import is_dirty
+
+
+# Table snapshots larger than this are spooled to a temporary file.
+SPOOL_SIZE = 10 * 1024 * 1024
+
+REFERENCING_TABLES_SQL = """
+    SELECT DISTINCT conrelid::regclass::text
+    FROM pg_constraint
+    WHERE contype = 'f' AND confrelid = ANY(%s::regclass[])
+"""
+
+ALL_TABLES_SQL = """
+    SELECT c.oid::regclass::text
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind = 'r'
+      AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+      AND n.nspname NOT LIKE 'pg_%'
+    ORDER BY 1
+"""
+
+SEQUENCES_SQL = """
+    SELECT seq.oid::regclass::text
+    FROM pg_class seq
+    JOIN pg_depend dep ON dep.objid = seq.oid AND dep.deptype IN ('a', 'i')
+    WHERE seq.relkind = 'S' AND dep.refobjid = %s::regclass
+"""
+
+
+def get_source_connection(connection):
+    """Return a new connection to the template (source) database."""
+    settings_dict = connection.settings_dict.copy()
+    settings_dict['NAME'] = settings_dict['ORIGINAL_NAME']
+    return connection.__class__(settings_dict, alias=connection.alias)
+
+
+def get_dependent_tables(cursor, tables):
+    """Return the tables plus every table that references them.
+
+    Tables referencing a restored table have to be restored as well because
+    they can't survive the TRUNCATE of the table they reference.
+
+    """
+    cursor.execute('SELECT unnest(%s::regclass[])::text', [list(tables)])
+    tables = set(row[0] for row in cursor.fetchall())
+    while True:
+        cursor.execute(REFERENCING_TABLES_SQL, [list(tables)])
+        referencing = set(row[0] for row in cursor.fetchall()) - tables
+        if not referencing:
+            return sorted(tables)
+        tables.update(referencing)
+
+
+def get_table_snapshots(connection, tables):
+    """Return snapshots of the tables as they are in the template database.
+
+    The data of each table is copied from the template database once and
+    cached for the rest of the test run along with the state of the sequences
+    owned by the table. The connection to the template database is closed
+    afterwards because postgres can't clone a template that has sessions.
+
+    """
+    snapshots = getattr(connection.creation, 'ttdb_table_snapshots', None)
+    if snapshots is None:
+        snapshots = connection.creation.ttdb_table_snapshots = {}
+
+    missing = [table for table in tables if table not in snapshots]
+    if not missing:
+        return snapshots
+
+    source = get_source_connection(connection)
+    try:
+        with source.cursor() as cursor:
+            for table in missing:
+                data = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+                cursor.copy_expert('COPY %s TO STDOUT (FORMAT binary)' % table, data)
+                cursor.execute(SEQUENCES_SQL, [table])
+                sequences = []
+                for sequence, in cursor.fetchall():
+                    cursor.execute('SELECT last_value, is_called FROM %s' % sequence)
+                    sequences.append((sequence,) + tuple(cursor.fetchone()))
+                snapshots[table] = (data, sequences)
+    finally:
+        source.close()
+    return snapshots
+
+
+def snapshot_all_tables(connection):
+    """Snapshot every table of the template database.
+
+    Used by the 'copy' reload mode, which restores every table on reload.
+
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(ALL_TABLES_SQL)
+        connection.creation.ttdb_all_tables = [row[0] for row in cursor.fetchall()]
+    get_table_snapshots(connection, connection.creation.ttdb_all_tables)
+
+
+def restore_tables(connection, tables):
+    """Truncate the tables and copy their data back from the snapshots.
+
+    Returns False if the tables can't be restored.
+
+    """
+    try:
+        snapshots = get_table_snapshots(connection, tables)
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+                cursor.execute('TRUNCATE %s' % ', '.join(tables))
+                for table in tables:
+                    data, sequences = snapshots[table]
+                    data.seek(0)
+                    cursor.copy_expert('COPY %s FROM STDIN (FORMAT binary)' % table, data)
+                    for sequence, last_value, is_called in sequences:
+                        cursor.execute(
+                            'SELECT setval(%s, %s, %s)',
+                            [sequence, last_value, is_called])
+    except DatabaseError:
+        return False
+    return True
+
+
+def restore_modified_tables(connection):
+    """Restore the tables modified since the database was last reloaded.
+
+    Returns False if the modifications are unknown (for example because DDL
+    was executed) or can't be restored, in which case the database has to be
+    recreated from the template.
+
+    """
+    tables = get_tracked_tables(connection)
+    if tables is None or connection.vendor != 'postgresql':
+        return False
+    if not tables:
+        return True
+
+    try:
+        with connection.cursor() as cursor:
+            tables = get_dependent_tables(cursor, tables)
+    except DatabaseError:
+        return False
+    return restore_tables(connection, tables)
+
+
+def restore_all_tables(connection, skip_clean=False):
+    """Restore every table of the database from the snapshots.
+
+    All tables are truncated in one statement, which is faster than
+    recreating a small database. Nothing is restored if skip_clean is True
+    and no writes were tracked. Returns False if the modifications are
+    unknown or the tables can't be restored.
+
+    """
+    if get_tracked_tables(connection) is None:
+        return False
+    if skip_clean and not is_dirty(connection):
+        return True
+    return restore_tables(connection, connection.creation.ttdb_all_tables)
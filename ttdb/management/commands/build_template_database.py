@@ -0,0 +1,36 @@
+"""Build template databases from migrations and data files."""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connections
+
+from ttdb.builder import build_template_database
+
+
+class Command(BaseCommand):
+
+    """Migrate template databases and load the data files that changed."""
+
+    help = 'Migrates template databases and loads the BUILD_STEPS that changed into them.'
+
+    def add_arguments(self, parser):
+        """Add the aliases and the --force option."""
+        parser.add_argument(
+            'aliases', nargs='*',
+            help='Template databases to build, every database in TTDB by default.')
+        parser.add_argument(
+            '--force', action='store_true', default=False,
+            help='Load every step, even if its inputs did not change.')
+
+    def handle(self, *args, **options):
+        """Build every template database."""
+        aliases = options['aliases'] or list(settings.TTDB)
+        for alias in aliases:
+            if alias not in settings.TTDB:
+                raise CommandError('%s is not a template database.' % alias)
+            if connections[alias].vendor != 'postgresql':
+                raise CommandError('%s is not a postgres database.' % alias)
+            steps = build_template_database(alias, options['force'], self.stdout)
+            if options['verbosity'] >= 1:
+                self.stdout.write('Built %s, %d step(s) loaded.' % (alias, len(steps)))
@@ -0,0 +1,112 @@
+"""Pool of spare test databases cloned from a template in the background."""
+
+import itertools
+import threading
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+from ttdb.utils import create_database_from_template
+from ttdb.utils import drop_database
+from ttdb.utils import relax_durability
+
+
+class TemplateDatabasePool(object):
+
+    """Keep a number of fresh copies of a template database ready for use.
+
+    A background thread clones the template database (``ORIGINAL_NAME``) into
+    spare databases. When a test database needs to be reloaded a spare is
+    swapped into the connection settings and the dirty database is dropped by
+    the background thread, so the test never waits for a drop or a clone
+    unless the pool has run dry.
+
+    """
+
+    def __init__(self, connection, size):
+        """Prepare the pool for the given connection."""
+        self.connection = connection
+        self.size = size
+        self.spares = queue.Queue()
+        self.tasks = queue.Queue()
+        self.undropped = []
+        self.counter = itertools.count(1)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        """Start cloning spare databases in the background."""
+        for i in range(self.size):
+            self.tasks.put(('clone', None))
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background thread and drop every remaining database."""
+        self.tasks.put((None, None))
+        self.thread.join()
+
+        while True:
+            try:
+                name = self.spares.get_nowait()
+            except queue.Empty:
+                break
+            if name is not None:
+                self.undropped.append(name)
+
+        for name in self.undropped:
+            self.drop(name)
+        self.undropped = []
+
+    def swap(self):
+        """Swap a spare database into the connection settings.
+
+        Blocks until a spare is ready. Returns False if the spare could not be
+        created, in which case the caller should reload the database itself.
+
+        """
+        name = self.spares.get()
+        if name is None:
+            # Try again to keep the pool at its size.
+            self.tasks.put(('clone', None))
+            return False
+
+        old_name = self.connection.settings_dict['NAME']
+        self.connection.close()
+        self.connection.settings_dict['NAME'] = name
+
+        self.tasks.put(('drop', old_name))
+        self.tasks.put(('clone', None))
+        return True
+
+    def run(self):
+        """Process clone and drop tasks until the pool is stopped."""
+        while True:
+            action, name = self.tasks.get()
+            if action is None:
+                break
+            elif action == 'clone':
+                self.spares.put(self.clone())
+            elif action == 'drop':
+                try:
+                    self.drop(name)
+                except Exception:
+                    # Another thread may still be connected to the database,
+                    # try again when the pool is stopped.
+                    self.undropped.append(name)
+
+    def clone(self):
+        """Clone the template into a new spare database and return its name."""
+        name = '%s_ttdb%d' % (
+            self.connection.creation._get_test_db_name(), next(self.counter))
+        try:
+            create_database_from_template(self.connection, name)
+            relax_durability(self.connection, name)
+        except Exception:
+            return None
+        return name
+
+    def drop(self, name):
+        """Drop a database that is no longer used."""
+        drop_database(self.connection, name)
@@ -0,0 +1,135 @@
+"""Route the default database to a template test database."""
+
+import threading
+
+try:
+    from contextvars import ContextVar
+except ImportError:  # Python < 3.7
+    ContextVar = None
+
+from django.db import DEFAULT_DB_ALIAS
+from django.db.utils import ConnectionHandler
+
+
+# Value of the route of a thread or asyncio task that never started a route.
+_UNSET = object()
+
+if ContextVar is not None:
+    _routed_alias = ContextVar('ttdb_routed_alias', default=_UNSET)
+
+    def _get_context_alias():
+        return _routed_alias.get()
+
+    def _set_context_alias(alias):
+        _routed_alias.set(alias)
+else:
+    _local = threading.local()
+
+    def _get_context_alias():
+        return getattr(_local, 'alias', _UNSET)
+
+    def _set_context_alias(alias):
+        _local.alias = alias
+
+# Alias the default database is routed to in threads and tasks without a
+# route of their own.
+_shared_alias = None
+
+# Active routes, in the order they were started. Threads that never started
+# a route of their own, such as the threads started by a test, inherit the
+# route that was started last.
+_started_routes = []
+
+
+def get_routed_alias():
+    """Return the alias the default database is routed to, if any.
+
+    Routes are local to the current thread or asyncio task. A thread that
+    never started a route inherits the route that was started last, so the
+    threads a test starts use the same database as the test. Shared routes
+    apply to every thread and task without a route of its own.
+
+    """
+    alias = _get_context_alias()
+    if alias is _UNSET:
+        alias = _started_routes[-1].db_name if _started_routes else None
+    return alias or _shared_alias
+
+
+class RoutingConnectionHandler(ConnectionHandler):
+
+    """Connection handler that resolves the default alias through the routes.
+
+    While a route is active, the default connection is the connection of the
+    template database and iterating over the connections only yields the
+    default alias.
+
+    """
+
+    def __getitem__(self, alias):
+        """Return the connection of the template database for the default alias."""
+        if alias == DEFAULT_DB_ALIAS:
+            alias = get_routed_alias() or alias
+        return super(RoutingConnectionHandler, self).__getitem__(alias)
+
+    def __iter__(self):
+        """Only yield the default alias while a route is active."""
+        if get_routed_alias():
+            return iter([DEFAULT_DB_ALIAS])
+        return super(RoutingConnectionHandler, self).__iter__()
+
+
+def install_routing():
+    """Make django's connection handler resolve the default alias through the routes."""
+    from django.db import connections
+
+    if not isinstance(connections, RoutingConnectionHandler):
+        connections.__class__ = RoutingConnectionHandler
+
+
+class TemplateDatabaseRoute(object):
+
+    """Make a template test database the default database.
+
+    The route applies to the current thread or asyncio task (each one can
+    route to a different template database at the same time), and to the
+    threads without a route of their own, such as the threads started by the
+    test. A shared route applies to every thread and task without a route of
+    its own, such as the live server thread. The connection stays open when
+    the route is stopped so switching back to the template database is cheap.
+    Routes can be nested, each one restores the route that was active before
+    it was started.
+
+    """
+
+    def __init__(self, db_name, shared=False):
+        """Store the alias of the template database."""
+        self.db_name = db_name
+        self.shared = shared
+        self.saved = None
+
+    def start(self):
+        """Route the default database to the template database."""
+        global _shared_alias
+
+        install_routing()
+        if self.shared:
+            self.saved = _shared_alias
+            _shared_alias = self.db_name
+        else:
+            self.saved = _get_context_alias()
+            _set_context_alias(self.db_name)
+            _started_routes.append(self)
+
+    def stop(self):
+        """Restore the route that was active before this one."""
+        global _shared_alias
+
+        if self.shared:
+            _shared_alias = self.saved
+        else:
+            # Once a route was stopped the thread or task no longer inherits
+            # the routes of others.
+            _set_context_alias(None if self.saved is _UNSET else self.saved)
+            _started_routes.remove(self)
+        self.saved = None
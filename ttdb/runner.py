@@ -1,4 +1,6 @@
-"""Test runner that creates a database using a postgresql template db."""
+"""Test runner that creates a database using a template db."""
+
+from __future__ import print_function
 
 import functools
 import mock
@@ -6,6 +8,41 @@ import mock
 from django.conf import settings
 from django.test import TransactionTestCase
 from django.test.runner import DiscoverRunner as Runner
+from django.utils.module_loading import import_string
+
+from ttdb.builder import build_layer
+from ttdb.builder import get_layer_settings
+from ttdb.cache import get_snapshot
+from ttdb.fingerprint import clear_database_fingerprint
+from ttdb.fingerprint import get_database_fingerprint
+from ttdb.fingerprint import get_template_fingerprint
+from ttdb.fingerprint import set_database_fingerprint
+from ttdb.incremental import snapshot_all_tables
+from ttdb.pool import TemplateDatabasePool
+from ttdb.suite import get_template_usage
+from ttdb.suite import reorder_template_tests
+from ttdb.timing import TimingTestRunner
+from ttdb.timing import timed
+from ttdb.timing import timings
+from ttdb.tracking import is_dirty
+from ttdb.tracking import track_writes
+from ttdb.utils import analyze_template
+from ttdb.utils import create_database_from_template
+from ttdb.utils import database_exists
+from ttdb.utils import drop_database
+from ttdb.utils import get_template_option
+from ttdb.utils import prewarm_database
+from ttdb.utils import relax_durability
+from ttdb.utils import run_concurrently
+from ttdb.utils import terminate_database_sessions
+from ttdb.utils import wait_for_template
+
+
+# Reset backends used for template databases without a RESET_BACKEND option.
+DEFAULT_RESET_BACKENDS = {
+    'mysql': 'ttdb.backends.mysql.MySQLResetBackend',
+    'sqlite': 'ttdb.backends.sqlite.SQLiteResetBackend',
+}
 
 
 def sql_table_creation_suffix(self):
@@ -17,7 +54,8 @@ def create_test_db(self, *args, **kwargs):
     """Disable syncdb on test creation because database already contains data."""
     from django.core.management.commands import migrate
 
-    if kwargs.get('reload', False) is True:
+    reloading = kwargs.get('reload', False) is True
+    if reloading:
         if hasattr(self, 'create_test_db_kwargs'):
             kwargs = self.create_test_db_kwargs
         if hasattr(self, 'create_test_db_args'):
@@ -26,14 +64,105 @@ def create_test_db(self, *args, **kwargs):
         self.create_test_db_kwargs = kwargs
         self.create_test_db_args = args
 
-    if 'reload' in kwargs:
-        del kwargs['reload']
+    kwargs = dict(kwargs)
+    kwargs.pop('reload', None)
+
+    if self.connection.alias not in settings.TTDB:
+        self._old_create_test_db(*args, **kwargs)
+        return
 
-    if self.connection.alias in settings.TTDB:
+    if not reloading and getattr(self, 'ttdb_defer_creation', False):
+        # Only point the connection at the test database, the runner creates
+        # it when it is first used.
+        self.ttdb_defer_creation = False
+        self.ttdb_deferred_args = (args, kwargs)
+        self.connection.settings_dict['NAME'] = self._get_test_db_name()
+        return
+
+    precreated = not reloading and getattr(self, 'ttdb_precreated', False)
+    if precreated:
+        # The runner already cloned the template, django only has to use it.
+        self.ttdb_precreated = False
+        kwargs['keepdb'] = True
+
+    keepdb = get_template_option(self.connection.alias, 'KEEPDB', False)
+    if keepdb and self.connection.vendor == 'postgresql':
+        # Reuse the test database from a previous run if it was created from
+        # the same template and was not modified.
+        test_database_name = self._get_test_db_name()
+        if not reloading:
+            self.ttdb_fingerprint = get_template_fingerprint(self.connection)
+        if not reloading and get_database_fingerprint(
+                self.connection, test_database_name) == self.ttdb_fingerprint:
+            kwargs['keepdb'] = True
+            # The fingerprint is only stored again if the database is still
+            # unmodified when the run completes, see teardown_databases.
+            clear_database_fingerprint(self.connection, test_database_name)
+        else:
+            drop_database(self.connection, test_database_name)
+            kwargs['keepdb'] = False
+
+    if not kwargs.get('keepdb') and self.connection.vendor == 'postgresql':
+        # django gives up if the template is in use.
+        wait_for_template(self.connection)
+
+    with timed('create', self.connection.alias):
         with mock.patch.object(migrate, 'Command'):
             self._old_create_test_db(*args, **kwargs)
+    if not precreated and self.connection.vendor == 'postgresql':
+        relax_durability(self.connection, tables=False)
+        prewarm_database(self.connection)
+
+
+def destroy_test_db(self, *args, **kwargs):
+    """Keep the test database if the runner decided it can be reused.
+
+    The sessions still connected to a postgres test database are terminated
+    before it is dropped. Databases the runner already dropped are not
+    dropped again. Nothing is dropped if the creation of the test database
+    was deferred and it was never used.
+
+    """
+    # django 2.2 renamed the number argument of parallel test databases.
+    suffix = args[3] if len(args) > 3 else kwargs.get('suffix', kwargs.get('number'))
+    if getattr(self, 'ttdb_lazy', None) is not None and suffix is None:
+        self.ttdb_lazy = None
+        self.connection.settings_dict['NAME'] = (
+            args[0] if args else kwargs.get('old_database_name'))
+        return
+    if suffix is None:
+        skip_drop = getattr(self, 'ttdb_keep', False) or getattr(self, 'ttdb_dropped', False)
+        self.ttdb_dropped = False
+        name = self.connection.settings_dict['NAME']
     else:
-        self._old_create_test_db(*args, **kwargs)
+        skip_drop = getattr(self, 'ttdb_dropped_clones', False)
+        name = self.get_test_db_clone_settings(suffix)['NAME']
+    keepdb = args[2] if len(args) > 2 else kwargs.get('keepdb', False)
+    if not skip_drop and not keepdb and self.connection.vendor == 'postgresql':
+        # Sessions left on the database would make django's drop fail.
+        self.connection.close()
+        terminate_database_sessions(self.connection, name)
+    if skip_drop:
+        # Kept for the next run or already dropped by the runner.
+        kwargs['keepdb'] = True
+        args = args[:2]
+    with timed('drop', self.connection.alias):
+        self._old_destroy_test_db(*args, **kwargs)
+
+
+def clone_test_db(self, *args, **kwargs):
+    """Defer cloning so the runner can clone the template for every worker at once.
+
+    Only postgres databases are cloned from the template, the other backends
+    clone the test database the way django does.
+
+    """
+    if self.connection.alias in settings.TTDB and self.connection.vendor == 'postgresql':
+        # django 2.2 renamed the number argument to suffix.
+        self.ttdb_clones.append(
+            args[0] if args else kwargs.get('suffix', kwargs.get('number')))
+    else:
+        self._old_clone_test_db(*args, **kwargs)
 
 
 class TemplateDatabaseRunner(Runner):
@@ -46,24 +175,323 @@ class TemplateDatabaseRunner(Runner):
 
     """
 
+    test_runner = TimingTestRunner
+
     def __init__(self, **kwargs):
         """Prepare runner kwargs."""
         super(TemplateDatabaseRunner, self).__init__(**kwargs)
 
+    def build_suite(self, *args, **kwargs):
+        """Group the tests by template database to avoid reloads.
+
+        The template databases the tests use are remembered so the creation of
+        the others can be deferred (see the LAZY option). The suite is not
+        reordered when running tests in parallel because django has already
+        split it up between the workers.
+
+        """
+        suite = super(TemplateDatabaseRunner, self).build_suite(*args, **kwargs)
+        if getattr(self, 'parallel', 1) > 1:
+            return suite
+        self.template_aliases = set(
+            get_template_usage(test)[0] for test in suite) - set([None])
+        return suite.__class__(reorder_template_tests(suite, self.reorder_by))
+
     def setup_databases(self, **kwargs):
         """Handle template test databases differently."""
         from django.db import connections
 
+        for alias in settings.TTDB:
+            if '+' in alias and alias not in connections.databases:
+                connections.databases[alias] = get_layer_settings(alias)
+
         for alias in connections:
             connection = connections[alias]
-            if connection.alias in settings.TTDB:
+            # The creation methods are only patched once, so the databases
+            # can be set up more than once in the same process.
+            if (connection.alias in settings.TTDB and
+                    not hasattr(connection.creation, '_old_create_test_db')):
                 connection.settings_dict['ORIGINAL_NAME'] = connection.settings_dict['NAME']
 
-                connection.creation.sql_table_creation_suffix = functools.partial(
-                    sql_table_creation_suffix, connection.creation)
+                if connection.vendor == 'postgresql':
+                    connection.creation.sql_table_creation_suffix = functools.partial(
+                        sql_table_creation_suffix, connection.creation)
 
                 connection.creation._old_create_test_db = connection.creation.create_test_db
                 connection.creation.create_test_db = functools.partial(
                     create_test_db, connection.creation)
 
-        return super(TemplateDatabaseRunner, self).setup_databases(**kwargs)
+                connection.creation._old_destroy_test_db = connection.creation.destroy_test_db
+                connection.creation.destroy_test_db = functools.partial(
+                    destroy_test_db, connection.creation)
+
+                if hasattr(connection.creation, 'clone_test_db'):
+                    connection.creation.ttdb_clones = []
+                    connection.creation._old_clone_test_db = connection.creation.clone_test_db
+                    connection.creation.clone_test_db = functools.partial(
+                        clone_test_db, connection.creation)
+
+        for alias in settings.TTDB:
+            defer = connections[alias].creation.ttdb_defer_creation = self.defer_creation(alias)
+            if not defer:
+                self.prepare_template(alias)
+        self.create_template_databases()
+
+        old_config = super(TemplateDatabaseRunner, self).setup_databases(**kwargs)
+        self.clone_template_databases()
+        for alias in settings.TTDB:
+            creation = connections[alias].creation
+            if getattr(creation, 'ttdb_deferred_args', None) is not None:
+                creation.ttdb_lazy = functools.partial(self.create_deferred_database, alias)
+            else:
+                self.setup_template_database(alias)
+        return old_config
+
+    def defer_creation(self, alias):
+        """Return True if creating the template test database can wait.
+
+        With the LAZY option enabled, template test databases that are not
+        used by any test class or decorated test method are only created when
+        they are first switched to, so they are never created if no test uses
+        them.
+
+        """
+        return bool(
+            get_template_option(alias, 'LAZY', False) and
+            getattr(self, 'parallel', 1) <= 1 and
+            alias not in getattr(self, 'template_aliases', settings.TTDB))
+
+    def create_deferred_database(self, alias):
+        """Create a template test database whose creation was deferred."""
+        from django.db import connections
+
+        connection = connections[alias]
+        args, kwargs = connection.creation.ttdb_deferred_args
+        connection.creation.ttdb_deferred_args = None
+        connection.settings_dict['NAME'] = connection.settings_dict['ORIGINAL_NAME']
+        self.prepare_template(alias)
+        connection.creation.create_test_db(*args, **kwargs)
+        self.setup_template_database(alias)
+
+    def prepare_template(self, alias):
+        """Build the template of a layered alias and update its statistics.
+
+        Statistics are only updated with the ANALYZE option enabled. Copies of
+        the template keep the statistics, so the queries of the first tests
+        are planned well.
+
+        """
+        from django.db import connections
+
+        connection = connections[alias]
+        if '+' in alias:
+            build_layer(alias)
+        if get_template_option(alias, 'ANALYZE', False) and connection.vendor == 'postgresql':
+            analyze_template(connection)
+
+    def create_template_databases(self):
+        """Clone the postgres template databases concurrently.
+
+        django creates the test databases one after the other, so the runner
+        clones the templates up front and django reuses the clones. At most
+        TTDB_SETUP_WORKERS databases are cloned at the same time. Templates
+        with the KEEPDB option are left to create_test_db. In an interactive
+        run test databases that already exist are left to django as well, so
+        it asks before dropping them.
+
+        """
+        from django.db import connections
+
+        tasks = []
+        for alias in settings.TTDB:
+            connection = connections[alias]
+            creation = connection.creation
+            if (connection.vendor != 'postgresql' or creation.ttdb_defer_creation or
+                    connection.settings_dict.get('TEST', {}).get('MIRROR') or
+                    get_template_option(alias, 'KEEPDB', False)):
+                continue
+            name = creation._get_test_db_name()
+            if self.interactive and database_exists(connection, name):
+                continue
+            creation.ttdb_precreated = True
+            tasks.append(functools.partial(create_database_from_template, connection, name))
+        run_concurrently(tasks, self.setup_workers)
+
+    def drop_template_databases(self):
+        """Drop the postgres template test databases concurrently.
+
+        The test databases of parallel test workers are dropped as well.
+        destroy_test_db skips the databases dropped here.
+
+        """
+        from django.db import connections
+
+        tasks = []
+        for alias in settings.TTDB:
+            connection = connections[alias]
+            creation = connection.creation
+            if (connection.vendor != 'postgresql' or creation.ttdb_keep or
+                    getattr(creation, 'ttdb_lazy', None) is not None or
+                    connection.settings_dict.get('TEST', {}).get('MIRROR')):
+                continue
+            names = [connection.settings_dict['NAME']]
+            if getattr(self, 'parallel', 1) > 1 and hasattr(creation, 'get_test_db_clone_settings'):
+                names.extend(creation.get_test_db_clone_settings(number)['NAME']
+                             for number in range(1, self.parallel + 1))
+                creation.ttdb_dropped_clones = True
+            connection.close()
+            creation.ttdb_dropped = True
+            tasks.extend(functools.partial(drop_database, connection, name) for name in names)
+        run_concurrently(tasks, self.setup_workers)
+
+    @property
+    def setup_workers(self):
+        """Return how many databases are cloned or dropped at the same time."""
+        return getattr(settings, 'TTDB_SETUP_WORKERS', 4)
+
+    def setup_template_database(self, alias):
+        """Prepare a template test database once it has been created."""
+        from django.db import connections
+
+        track_writes(connections[alias])
+        self.setup_reload_mode(alias)
+        self.setup_reset_backend(alias)
+        if get_template_option(alias, 'CACHED_MODELS'):
+            # Parallel test workers forked later on inherit the reference data.
+            get_snapshot(alias)
+        if getattr(self, 'parallel', 1) <= 1:
+            self.start_template_pool(alias)
+
+    def teardown_databases(self, old_config, **kwargs):
+        """Stop the spare database pools before destroying the databases.
+
+        Unmodified KEEPDB test databases get the fingerprint of their template,
+        so a run that is interrupted never leaves a fingerprint behind. The
+        other template test databases are dropped concurrently before django
+        destroys the other test databases.
+
+        """
+        from django.db import connections
+
+        self.stop_template_pools()
+        self.teardown_reset_backends()
+        for alias in settings.TTDB:
+            connection = connections[alias]
+            connection.creation.ttdb_keep = bool(
+                get_template_option(alias, 'KEEPDB', False) and
+                not is_dirty(connection) and
+                connection.settings_dict['NAME'] == connection.creation._get_test_db_name())
+            fingerprint = getattr(connection.creation, 'ttdb_fingerprint', None)
+            if connection.creation.ttdb_keep and fingerprint and connection.vendor == 'postgresql':
+                set_database_fingerprint(connection, connection.settings_dict['NAME'], fingerprint)
+        self.drop_template_databases()
+        super(TemplateDatabaseRunner, self).teardown_databases(old_config, **kwargs)
+        self.report_timings()
+
+    def report_timings(self):
+        """Write the timings of template database operations and print a summary.
+
+        The timings are written to the file named by the TTDB_TIMINGS_FILE
+        setting. The summary is printed with TTDB_TIMINGS_SUMMARY enabled or
+        a verbosity of 2 or more.
+
+        """
+        path = getattr(settings, 'TTDB_TIMINGS_FILE', None)
+        if path:
+            timings.write(path)
+        if timings.events and (getattr(settings, 'TTDB_TIMINGS_SUMMARY', False) or
+                               self.verbosity >= 2):
+            print(timings.format_summary())
+
+    def clone_template_databases(self):
+        """Clone the template database for each parallel test worker.
+
+        Every worker gets its own copy of the template database so that a
+        reload in one worker only recreates that worker's copy. The copies are
+        created concurrently, at most TTDB_SETUP_WORKERS at a time.
+
+        """
+        from django.db import connections
+
+        tasks = []
+        for alias in settings.TTDB:
+            creation = connections[alias].creation
+            for number in getattr(creation, 'ttdb_clones', []):
+                name = creation.get_test_db_clone_settings(number)['NAME']
+                tasks.append(functools.partial(
+                    create_database_from_template, connections[alias], name))
+            creation.ttdb_clones = []
+        run_concurrently(tasks, self.setup_workers)
+
+    def setup_reload_mode(self, alias):
+        """Decide how a postgres template test database is reloaded.
+
+        Without a RELOAD_MODE option, template databases smaller than the
+        COPY_MAX_SIZE option (in bytes) are reloaded by restoring every table
+        from a snapshot taken now, because that is faster than recreating a
+        small database. Databases that are restored instead of recreated are
+        kept for the whole run, so their durability is relaxed (see
+        relax_durability).
+
+        """
+        from django.db import connections
+
+        connection = connections[alias]
+        if connection.vendor != 'postgresql':
+            return
+        mode = get_template_option(alias, 'RELOAD_MODE')
+        max_size = get_template_option(alias, 'COPY_MAX_SIZE')
+        if mode is None and max_size:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_database_size(current_database())')
+                mode = 'copy' if cursor.fetchone()[0] < max_size else 'clone'
+        if mode in ('tables', 'copy'):
+            # The database is kept for the whole run.
+            relax_durability(connection)
+        if mode == 'copy':
+            snapshot_all_tables(connection)
+        connection.creation.ttdb_reload_mode = mode
+
+    def setup_reset_backend(self, alias):
+        """Set up the reset backend of a template with a RESET_BACKEND."""
+        from django.db import connections
+
+        path = get_template_option(
+            alias, 'RESET_BACKEND',
+            DEFAULT_RESET_BACKENDS.get(connections[alias].vendor))
+        if path:
+            backend = import_string(path)(connections[alias])
+            backend.setup()
+            connections[alias].creation.ttdb_reset_backend = backend
+
+    def teardown_reset_backends(self):
+        """Tear down the reset backends before the databases are destroyed."""
+        from django.db import connections
+
+        for alias in settings.TTDB:
+            creation = connections[alias].creation
+            backend = getattr(creation, 'ttdb_reset_backend', None)
+            if backend is not None:
+                backend.teardown()
+                del creation.ttdb_reset_backend
+
+    def start_template_pool(self, alias):
+        """Start cloning spare databases for a template with a POOL_SIZE."""
+        from django.db import connections
+
+        connection = connections[alias]
+        size = get_template_option(alias, 'POOL_SIZE', 0)
+        if size and connection.vendor == 'postgresql':
+            connection.creation.ttdb_pool = TemplateDatabasePool(connection, size)
+            connection.creation.ttdb_pool.start()
+
+    def stop_template_pools(self):
+        """Stop the spare database pools and drop the spare databases."""
+        from django.db import connections
+
+        for alias in settings.TTDB:
+            creation = connections[alias].creation
+            pool = getattr(creation, 'ttdb_pool', None)
+            if pool is not None:
+                pool.stop()
+                del creation.ttdb_pool
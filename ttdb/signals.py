@@ -0,0 +1,10 @@
+"""Signals sent by ttdb."""
+
+from django.dispatch import Signal
+
+
+# Sent after every timed template database operation. The arguments are the
+# operation ('create', 'clone', 'drop', 'reload', 'switch', 'restore',
+# 'analyze', 'prewarm', 'unlogged', 'load' or 'test'), the alias of the
+# database, the test class that was running and the duration in seconds.
+database_operation = Signal()
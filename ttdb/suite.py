@@ -0,0 +1,122 @@
+"""Inspect and reorder test suites based on the template databases they use."""
+
+from django.test import TestCase
+
+
+# Order in which tests sharing a template test database in each scope run.
+SCOPE_RANKS = {
+    'session': 0,
+    'class': 1,
+    'module': 1,
+    'method': 2,
+}
+
+
+def get_template_isolation(obj, test):
+    """Return how a test is isolated from the changes of other tests.
+
+    Either 'reload' or 'savepoint'. obj is the decorated test method or the
+    test itself. Test methods of a TestCase decorated without an isolation
+    option run in an atomic block that is rolled back, like TestCase does for
+    the default database.
+
+    """
+    isolation = getattr(obj, 'isolation', None)
+    if isolation is None:
+        if obj is not test and isinstance(test, TestCase):
+            return 'savepoint'
+        return 'reload'
+    return isolation
+
+
+def get_template_usage(test):
+    """Return the template database a test uses and if it reloads it afterwards.
+
+    Looks at the test method first (decorated with use_template_database) and
+    then at the test class. Returns (None, False) for tests that don't use a
+    template database.
+
+    """
+    method = getattr(test, getattr(test, '_testMethodName', ''), None)
+    for obj in (method, test):
+        alias = getattr(obj, 'template_database', None)
+        if alias is not None:
+            reloads = (
+                getattr(obj, 'reload_after_test', False) is True and
+                get_template_isolation(obj, test) != 'savepoint')
+            return alias, reloads
+    return None, False
+
+
+def get_template_scope(test):
+    """Return the scope in which a test shares its template test database.
+
+    Either 'method' (reloaded after the test), 'class' or 'module' (reloaded
+    once no test of the same class or module uses it anymore) or 'session'
+    (never reloaded). Tests without a scope option are in the 'method' scope
+    if they reload the database and in the 'session' scope otherwise, like
+    tests with savepoint isolation.
+
+    """
+    method = getattr(test, getattr(test, '_testMethodName', ''), None)
+    for obj in (method, test):
+        if getattr(obj, 'template_database', None) is not None:
+            if get_template_isolation(obj, test) == 'savepoint':
+                return 'session'
+            scope = getattr(obj, 'scope', None)
+            if scope is not None:
+                return scope
+            return 'method' if get_template_usage(test)[1] else 'session'
+    return 'session'
+
+
+def get_template_scope_key(test_class, scope):
+    """Return what tests sharing a template test database have in common.
+
+    Returns None for the 'method' and 'session' scopes.
+
+    """
+    if scope == 'class':
+        return '%s.%s' % (test_class.__module__, test_class.__name__)
+    if scope == 'module':
+        return test_class.__module__
+    return None
+
+
+def reorder_template_tests(tests, reorder_by):
+    """Group tests by template database and run read only tests first.
+
+    Tests keep the order of the reorder_by classes django uses (TestCase
+    first). Within each of those groups test classes are ordered by the
+    template database they use, with the test classes that don't reload the
+    database first, then those sharing it within a class or module (grouped
+    by module) and last those that reload it after every test. Tests of the
+    same class stay together and keep their order.
+
+    """
+    tests = list(tests)
+    classes = {}
+    for index, test in enumerate(tests):
+        alias = get_template_usage(test)[0]
+        scope = get_template_scope(test)
+        rank = SCOPE_RANKS.get(scope, 0)
+        group = test.__class__.__module__ if scope == 'module' else ''
+        if test.__class__ not in classes:
+            classes[test.__class__] = [alias, rank, group, index]
+        else:
+            usage = classes[test.__class__]
+            usage[0] = usage[0] or alias
+            if rank > usage[1]:
+                usage[1:3] = [rank, group]
+
+    def key(item):
+        index, test = item
+        bucket = len(reorder_by)
+        for i, test_type in enumerate(reorder_by):
+            if isinstance(test, test_type):
+                bucket = i
+                break
+        alias, rank, group, first_index = classes[test.__class__]
+        return (bucket, alias or '', rank, group, first_index, index)
+
+    return [test for index, test in sorted(enumerate(tests), key=key)]
@@ -6,9 +6,31 @@ from django.test import TransactionTestCase
 from django.test import LiveServerTestCase
 from django.core.management import call_command
 import mock
-from ttdb.utils import reload_template_database
+from ttdb.cache import disable_reference_cache
+from ttdb.cache import enable_reference_cache
+from ttdb.suite import get_template_isolation
+from ttdb.suite import get_template_scope
+from ttdb.suite import get_template_scope_key
+from ttdb.utils import schedule_template_database_reload
 from ttdb.utils import restore_default_database
 from ttdb.utils import enable_template_database 
+from ttdb.utils import mark_template_database_dirty
+from ttdb.utils import finish_template_test
+from ttdb.utils import start_savepoint_isolation
+from ttdb.utils import end_savepoint_isolation
+
+
+def get_scope_key(test):
+    """Return the scope key of a test (see get_template_scope_key)."""
+    return get_template_scope_key(test.__class__, get_template_scope(test))
+
+
+def get_isolation(test):
+    """Return the isolation of a test, from its decorated method if any."""
+    method = getattr(test, test._testMethodName, None)
+    if getattr(method, 'template_database', None) is None:
+        method = test
+    return get_template_isolation(method, test)
 
 
 class TemplateDBTestCase(TestCase):
@@ -16,18 +38,31 @@ class TemplateDBTestCase(TestCase):
     """TestCase with TemplateDB support."""
 
     reload_after_test = False
+    scope = None
+    cache_reference_data = False
 
     def _pre_setup(self):
-        """Switch to the template database before each test case."""
-        self._templatedb_patches = enable_template_database(self.template_database)
+        """Switch to the template database before each test case.
+
+        With cache_reference_data enabled, querysets wrapped in
+        ttdb.cache.cacheable are served from a snapshot of the CACHED_MODELS
+        of the template database.
+
+        """
+        self._templatedb_route = enable_template_database(
+            self.template_database, scope_key=get_scope_key(self))
+        if self.cache_reference_data:
+            enable_reference_cache(self.template_database)
         super(TemplateDBTestCase, self)._pre_setup()
 
     def _post_teardown(self):
         """Restore the default database after each test case."""
         super(TemplateDBTestCase, self)._post_teardown()
-        restore_default_database(*self._templatedb_patches)
-        if self.reload_after_test is True:
-            reload_template_database(self.template_database)
+        if self.cache_reference_data:
+            disable_reference_cache(self.template_database)
+        restore_default_database(self._templatedb_route)
+        finish_template_test(
+            self.template_database, get_template_scope(self), get_scope_key(self))
 
 
 class TemplateDBTransactionTestCase(TransactionTestCase):
@@ -35,20 +70,29 @@ class TemplateDBTransactionTestCase(TransactionTestCase):
     """TransactionTestCase with TemplateDB support."""
 
     reload_after_test = True
+    isolation = 'reload'
+    scope = None
 
     def _pre_setup(self):
         """Switch to the template database before each test case."""
-        self._templatedb_patches = enable_template_database(self.template_database)
+        self._templatedb_route = enable_template_database(
+            self.template_database, scope_key=get_scope_key(self))
+        self._templatedb_isolation = get_isolation(self)
+        if self._templatedb_isolation == 'savepoint':
+            self._templatedb_atomic = start_savepoint_isolation(self.template_database)
         with mock.patch('django.core.management.commands.flush.Command'):
             super(TemplateDBTransactionTestCase, self)._pre_setup()
 
     def _post_teardown(self):
         """Restore the default database after each test case."""
+        if self._templatedb_isolation == 'savepoint':
+            # Roll back before the connections are closed by the test case.
+            end_savepoint_isolation(self.template_database, self._templatedb_atomic)
         with mock.patch('django.core.management.commands.flush.Command'):
             super(TemplateDBTransactionTestCase, self)._post_teardown()
-        restore_default_database(*self._templatedb_patches)
-        if self.reload_after_test is True:
-            reload_template_database(self.template_database)
+        restore_default_database(self._templatedb_route)
+        finish_template_test(
+            self.template_database, get_template_scope(self), get_scope_key(self))
 
 
 class TemplateDBLiveServerTestCase(LiveServerTestCase):
@@ -56,20 +100,39 @@ class TemplateDBLiveServerTestCase(LiveServerTestCase):
     """LiveServerTestCase with TemplateDB support."""
 
     reload_after_test = True
+    scope = None
 
     @classmethod
     def setUpClass(cls):
-        """Switch to the template database before the LiveServer is started."""
-        cls._templatedb_patches = enable_template_database(cls.template_database)
+        """Switch to the template database before the LiveServer is started.
+
+        The route is shared so the live server thread uses the template
+        database as well.
+
+        """
+        # The database is switched for the whole class, so it can't be reloaded
+        # after each test.
+        cls._templatedb_scope = get_template_scope(cls)
+        if cls._templatedb_scope == 'method':
+            cls._templatedb_scope = 'class'
+        cls._templatedb_route = enable_template_database(
+            cls.template_database, shared=True,
+            scope_key=get_template_scope_key(cls, cls._templatedb_scope))
         super(TemplateDBLiveServerTestCase, cls).setUpClass()
 
     @classmethod
     def tearDownClass(cls):
         """Restore the defaut database after the LiveServer is stopped."""
         super(TemplateDBLiveServerTestCase, cls).tearDownClass()
-        restore_default_database(*cls._templatedb_patches)
-        if cls.reload_after_test is True:
-            reload_template_database(cls.template_database)
+        restore_default_database(cls._templatedb_route)
+        # Writes made by the live server thread are not tracked.
+        mark_template_database_dirty(cls.template_database)
+        if cls._templatedb_scope == 'class':
+            schedule_template_database_reload(cls.template_database)
+        else:
+            finish_template_test(
+                cls.template_database, cls._templatedb_scope,
+                get_template_scope_key(cls, cls._templatedb_scope))
 
     def _pre_setup(self):
         """Switch to the template database before each test case."""
@@ -0,0 +1,102 @@
+"""Record how long template database operations take."""
+
+import collections
+import contextlib
+import csv
+import json
+import threading
+import time
+import unittest
+
+from ttdb.signals import database_operation
+
+
+FIELDS = ('operation', 'alias', 'test', 'duration')
+
+
+class Timings(object):
+
+    """Collect the durations of template database operations."""
+
+    def __init__(self):
+        """Start without any events."""
+        self.events = []
+        self.current_test = None
+        self.lock = threading.Lock()
+
+    def record(self, operation, alias, duration):
+        """Record an operation and send the database_operation signal."""
+        event = {
+            'operation': operation,
+            'alias': alias,
+            'test': self.current_test,
+            'duration': duration,
+        }
+        with self.lock:
+            self.events.append(event)
+        database_operation.send(sender=self.__class__, **event)
+
+    def summarize(self, limit=10):
+        """Return the slowest operations, totalled per operation, alias and test."""
+        totals = collections.defaultdict(lambda: [0, 0.0])
+        for event in self.events:
+            total = totals[(event['operation'], event['alias'], event['test'])]
+            total[0] += 1
+            total[1] += event['duration']
+        rows = sorted(totals.items(), key=lambda item: -item[1][1])[:limit]
+        return [key + tuple(total) for key, total in rows]
+
+    def format_summary(self, limit=10):
+        """Return the summary as a table to print to the console."""
+        lines = ['Slowest template database operations:']
+        for operation, alias, test, count, duration in self.summarize(limit):
+            lines.append('%10.3fs %5dx %-8s %-12s %s' % (
+                duration, count, operation, alias or '', test or ''))
+        return '\n'.join(lines)
+
+    def write(self, path):
+        """Write every event to a CSV file if path ends with .csv, JSON otherwise."""
+        with open(path, 'w') as f:
+            if path.endswith('.csv'):
+                writer = csv.DictWriter(f, FIELDS)
+                writer.writeheader()
+                writer.writerows(self.events)
+            else:
+                json.dump(self.events, f, indent=2)
+
+
+timings = Timings()
+
+
+@contextlib.contextmanager
+def timed(operation, alias):
+    """Record how long the body of the with statement takes."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings.record(operation, alias, time.time() - start)
+
+
+class TimingTestResult(unittest.TextTestResult):
+
+    """Test result that records which test is running and how long it takes."""
+
+    def startTest(self, test):
+        """Remember the test class so operations can be attributed to it."""
+        timings.current_test = '%s.%s' % (
+            test.__class__.__module__, test.__class__.__name__)
+        self._ttdb_start = time.time()
+        super(TimingTestResult, self).startTest(test)
+
+    def stopTest(self, test):
+        """Record how long the test took."""
+        super(TimingTestResult, self).stopTest(test)
+        timings.record('test', None, time.time() - self._ttdb_start)
+
+
+class TimingTestRunner(unittest.TextTestRunner):
+
+    """Text test runner using the TimingTestResult."""
+
+    resultclass = TimingTestResult
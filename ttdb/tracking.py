@@ -0,0 +1,203 @@
+"""Track whether statements executed on a connection modified the database."""
+
+import functools
+import re
+import threading
+
+from django.db.backends.signals import connection_created
+
+
+# Statements that never modify the database, unless they call one of the
+# functions matched by WRITE_FUNCTIONS_RE.
+READ_STATEMENTS = (
+    'BEGIN',
+    'COMMIT',
+    'EXPLAIN',
+    'RELEASE',
+    'ROLLBACK',
+    'SAVEPOINT',
+    'SELECT',
+    'SET',
+    'SHOW',
+    'START',
+    'VALUES',
+)
+
+WRITE_FUNCTIONS_RE = re.compile(r'\b(nextval|setval)\s*\(', re.IGNORECASE)
+
+LEADING_COMMENTS_RE = re.compile(r'^(\s+|--[^\n]*\n?|/\*.*?\*/)+', re.DOTALL)
+
+NAME = r'(?:"(?:[^"]|"")+"|`[^`]+`|[\w$]+)'
+IDENTIFIER = r'%s(?:\.%s)?' % (NAME, NAME)
+
+# Data modifying statements and the table they write to.
+TABLE_WRITE_RE = re.compile(
+    r'^(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM)\s+(?:ONLY\s+)?(%s)' % IDENTIFIER,
+    re.IGNORECASE)
+
+TRUNCATE_RE = re.compile(
+    r'^TRUNCATE\s+(?:TABLE\s+)?(?:ONLY\s+)?((?:%s\s*,\s*)*%s)' % (IDENTIFIER, IDENTIFIER),
+    re.IGNORECASE)
+
+# Whether the database of each tracked alias was modified, and the tables
+# that were, by alias rather than by connection because every thread has a
+# connection of its own.
+_dirty = {}
+_modified_tables = {}
+_lock = threading.Lock()
+
+
+def is_write_statement(sql):
+    """Return True if the sql statement may modify the database."""
+    sql = LEADING_COMMENTS_RE.sub('', sql)
+    keyword = sql.split(None, 1)[0].upper() if sql else ''
+    if keyword in READ_STATEMENTS:
+        return WRITE_FUNCTIONS_RE.search(sql) is not None
+    return True
+
+
+def get_modified_tables(sql):
+    """Return the tables modified by the sql statement.
+
+    Returns None if the statement may modify the database in a way that is
+    not limited to the data of known tables, for example DDL statements.
+
+    """
+    sql = LEADING_COMMENTS_RE.sub('', sql)
+    match = TABLE_WRITE_RE.match(sql)
+    if match is not None:
+        return set([match.group(1)])
+    match = TRUNCATE_RE.match(sql)
+    if match is not None and not WRITE_FUNCTIONS_RE.search(sql):
+        return set(table.strip() for table in match.group(1).split(','))
+    return None
+
+
+def reset_tracking(connection):
+    """Mark the database of the connection as unmodified."""
+    with _lock:
+        _dirty[connection.alias] = False
+        _modified_tables[connection.alias] = set()
+
+
+def mark_dirty(connection, tables=None):
+    """Mark the database of the connection as modified.
+
+    If tables is None then the modifications are unknown and the database can
+    only be restored by recreating it.
+
+    """
+    with _lock:
+        _dirty[connection.alias] = True
+        if tables is None:
+            _modified_tables[connection.alias] = None
+        elif _modified_tables.get(connection.alias) is not None:
+            _modified_tables[connection.alias].update(tables)
+
+
+def is_dirty(connection):
+    """Return False if the database of the connection is known to be unmodified."""
+    return _dirty.get(connection.alias, True)
+
+
+def get_tracked_tables(connection):
+    """Return the tables modified since tracking was reset.
+
+    Returns None if the modifications are unknown or writes are not tracked.
+
+    """
+    return _modified_tables.get(connection.alias)
+
+
+class WriteTrackingCursorWrapper(object):
+
+    """Cursor wrapper that marks the connection dirty when a write is executed."""
+
+    def __init__(self, cursor, db):
+        """Wrap the cursor returned by the connection."""
+        self.cursor = cursor
+        self.db = db
+
+    def __getattr__(self, attr):
+        """Delegate everything else to the wrapped cursor."""
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        """Iterate over the wrapped cursor."""
+        return iter(self.cursor)
+
+    def __enter__(self):
+        """For using in with statement."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """For using in with statement."""
+        return self.cursor.__exit__(exc_type, exc_value, traceback)
+
+    def track(self, sql):
+        """Mark the connection dirty if the sql may modify the database."""
+        if get_tracked_tables(self.db) is not None and is_write_statement(sql):
+            mark_dirty(self.db, get_modified_tables(sql))
+
+    def callproc(self, procname, params=None):
+        """Procedures may do anything so always mark the connection dirty."""
+        mark_dirty(self.db)
+        return self.cursor.callproc(procname, params)
+
+    def execute(self, sql, params=None):
+        """Track and execute a statement."""
+        self.track(sql)
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        """Track and execute a statement for each set of params."""
+        self.track(sql)
+        return self.cursor.executemany(sql, param_list)
+
+    def copy_from(self, *args, **kwargs):
+        """COPY is not parsed so always mark the connection dirty."""
+        mark_dirty(self.db)
+        return self.cursor.copy_from(*args, **kwargs)
+
+    def copy_expert(self, *args, **kwargs):
+        """COPY is not parsed so always mark the connection dirty."""
+        mark_dirty(self.db)
+        return self.cursor.copy_expert(*args, **kwargs)
+
+    def copy_to(self, *args, **kwargs):
+        """COPY is not parsed so always mark the connection dirty."""
+        mark_dirty(self.db)
+        return self.cursor.copy_to(*args, **kwargs)
+
+
+def wrap_cursors(connection):
+    """Wrap every cursor the connection creates to track write statements."""
+    def wrap(make_cursor):
+        @functools.wraps(make_cursor)
+        def inner(cursor):
+            return WriteTrackingCursorWrapper(make_cursor(cursor), connection)
+        return inner
+
+    if getattr(connection, 'ttdb_tracked', False):
+        return
+    connection.make_cursor = wrap(connection.make_cursor)
+    connection.make_debug_cursor = wrap(connection.make_debug_cursor)
+    connection.ttdb_tracked = True
+
+
+def track_new_connection(sender, connection, **kwargs):
+    """Track the writes of connections other threads open to a tracked alias."""
+    if connection.alias in _dirty:
+        wrap_cursors(connection)
+
+
+def track_writes(connection):
+    """Track the writes to the database of the connection.
+
+    The connections of every thread to the same alias are tracked as well,
+    once they connect.
+
+    """
+    connection_created.connect(track_new_connection, dispatch_uid='ttdb_track_writes')
+    wrap_cursors(connection)
+    reset_tracking(connection)
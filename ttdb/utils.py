@@ -1,39 +1,573 @@
 """Helper functions for switching out the default database."""
 
 from django.conf import settings
+from django.db import DatabaseError
 import mock
+import threading
+import time
 
+from ttdb.incremental import get_source_connection
+from ttdb.incremental import restore_all_tables
+from ttdb.incremental import restore_modified_tables
+from ttdb.routing import TemplateDatabaseRoute
+from ttdb.timing import timed
+from ttdb.tracking import is_dirty
+from ttdb.tracking import mark_dirty
+from ttdb.tracking import reset_tracking
 
-def enable_template_database(db_name):
-    """Patch the default database db connection and settings dict."""
+
+SESSIONS_SQL = """
+    SELECT pid, usename, application_name, client_addr, state
+    FROM pg_stat_activity
+    WHERE datname = %s AND pid <> pg_backend_pid()
+"""
+
+LOGGED_TABLES_SQL = """
+    SELECT c.oid::regclass::text
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.relkind = 'r' AND c.relpersistence = 'p'
+      AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+      AND n.nspname NOT LIKE 'pg_%'
+"""
+
+# Tables modified since they were last analyzed, or never analyzed.
+UNANALYZED_TABLES_SQL = """
+    SELECT relid
+    FROM pg_stat_user_tables
+    WHERE n_mod_since_analyze > 0
+       OR (last_analyze IS NULL AND last_autoanalyze IS NULL)
+    LIMIT 1
+"""
+
+TERMINATE_SESSIONS_SQL = """
+    SELECT pg_terminate_backend(pid)
+    FROM pg_stat_activity
+    WHERE datname = %s AND pid <> pg_backend_pid()
+"""
+
+
+def get_template_option(db_name, option, default=None):
+    """Return a ttdb option for a template database.
+
+    Options are looked up in ``settings.TTDB_OPTIONS[db_name]`` first and then
+    fall back to the global ``settings.TTDB_<OPTION>`` setting.
+
+    """
+    options = getattr(settings, 'TTDB_OPTIONS', {}).get(db_name, {})
+    if option in options:
+        return options[option]
+    return getattr(settings, 'TTDB_%s' % option, default)
+
+
+class ResetBackend(object):
+
+    """Interface for backends that reset a template test database.
+
+    The runner creates a backend for each template database with the
+    RESET_BACKEND option set to the dotted path of a subclass. setup is called
+    once the test databases have been created and teardown before they are
+    destroyed. reload_template_database calls reset instead of recreating the
+    database.
+
+    """
+
+    def __init__(self, connection):
+        """Store the connection of the template test database."""
+        self.connection = connection
+
+    def setup(self):
+        """Prepare the backend."""
+
+    def reset(self):
+        """Reset the database to the template.
+
+        Return False if the database could not be reset, in which case it is
+        recreated from the template instead.
+
+        """
+        raise NotImplementedError
+
+    def teardown(self):
+        """Remove everything the backend created."""
+
+
+def get_reset_backend(db_name):
+    """Return the reset backend of a template database, if it has one."""
+    from django.db import connections
+
+    return getattr(connections[db_name].creation, 'ttdb_reset_backend', None)
+
+
+def execute_without_database(connection, sql, params=None):
+    """Execute sql using a new connection that is not bound to a database.
+
+    Returns the rows of the result, if any.
+
+    """
+    nodb_connection = connection.creation._nodb_connection
+    try:
+        with nodb_connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            if cursor.description is not None:
+                return cursor.fetchall()
+    finally:
+        nodb_connection.close()
+
+
+def get_server_version(connection):
+    """Return the version of the postgres server as a number, e.g. 130002."""
+    creation = connection.creation
+    if getattr(creation, 'ttdb_server_version', None) is None:
+        creation.ttdb_server_version = execute_without_database(
+            connection, 'SHOW server_version_num')[0][0]
+    return int(creation.ttdb_server_version)
+
+
+def get_database_sessions(connection, name):
+    """Describe the sessions connected to a postgres database."""
+    rows = execute_without_database(connection, SESSIONS_SQL, [name])
+    return ['pid %s (user %s, application %r, client %s, %s)' % tuple(row)
+            for row in rows]
+
+
+def database_exists(connection, name):
+    """Return True if the postgres database exists."""
+    return bool(execute_without_database(
+        connection, 'SELECT 1 FROM pg_database WHERE datname = %s', [name]))
+
+
+def terminate_database_sessions(connection, name):
+    """Terminate the sessions connected to a postgres database.
+
+    Returns the descriptions of the terminated sessions.
+
+    """
+    sessions = get_database_sessions(connection, name)
+    if sessions:
+        execute_without_database(connection, TERMINATE_SESSIONS_SQL, [name])
+    return sessions
+
+
+def wait_for_template(connection):
+    """Wait until no other session is connected to the template database.
+
+    postgres can't copy a template database that has sessions. The sessions
+    are checked up to CLONE_RETRIES times (5 by default) with a growing delay
+    and terminated before every check if the TERMINATE_TEMPLATE_SESSIONS option
+    is enabled. Raises DatabaseError listing the sessions if they remain.
+
+    """
+    template = connection.settings_dict['ORIGINAL_NAME']
+    retries = get_template_option(connection.alias, 'CLONE_RETRIES', 5)
+    terminate = get_template_option(connection.alias, 'TERMINATE_TEMPLATE_SESSIONS', False)
+    delay = 0.1
+    for attempt in range(retries + 1):
+        sessions = get_database_sessions(connection, template)
+        if not sessions:
+            return
+        if attempt == retries:
+            raise DatabaseError('The template database %s is in use by: %s' % (
+                template, ', '.join(sessions)))
+        if terminate:
+            terminate_database_sessions(connection, template)
+        time.sleep(delay)
+        delay *= 2
+
+
+def create_database_from_template(connection, name, prepare=True):
+    """Create a database named name as a copy of the template database.
+
+    An existing database with the same name is dropped first. The copy is
+    retried once if a session connected to the template in the meantime.
+    Unless prepare is False commits to the new database don't wait for the
+    write ahead log (see relax_durability) and it is prewarmed (see
+    prewarm_database).
+
+    """
+    quote_name = connection.ops.quote_name
+    sql = 'CREATE DATABASE %s WITH TEMPLATE %s' % (
+        quote_name(name), quote_name(connection.settings_dict['ORIGINAL_NAME']))
+    drop_database(connection, name)
+    with timed('clone', connection.alias):
+        wait_for_template(connection)
+        try:
+            execute_without_database(connection, sql)
+        except DatabaseError:
+            wait_for_template(connection)
+            execute_without_database(connection, sql)
+    if prepare:
+        relax_durability(connection, name, tables=False)
+        prewarm_database(connection, name)
+
+
+def analyze_template(connection):
+    """Update the planner statistics of the template database.
+
+    Copies of the template get its statistics, so they are only collected
+    once instead of for every copy. Nothing is done if no table was modified
+    since it was last analyzed, because analyzing writes to the template and
+    changes the fingerprint used by the KEEPDB option.
+
+    """
+    source = get_source_connection(connection)
+    try:
+        with timed('analyze', connection.alias):
+            with source.cursor() as cursor:
+                cursor.execute(UNANALYZED_TABLES_SQL)
+                if cursor.fetchone() is not None:
+                    cursor.execute('ANALYZE')
+    finally:
+        source.close()
+
+
+def relax_durability(connection, name=None, tables=True):
+    """Trade the durability of a copy of the template for speed.
+
+    Only done with the UNLOGGED option enabled. Commits to every copy don't
+    wait for the write ahead log to be flushed. Unless tables is False the
+    tables are made unlogged as well, so writes skip the write ahead log.
+    Making a table unlogged rewrites it, so this is only worth it for copies
+    that are used for more than one reload or made in the background. Tables
+    referenced by a table that can't be made unlogged stay logged. name is
+    the name of the copy, by default the database of the connection, whose
+    connection is closed so it picks up the new settings.
+
+    """
+    if not get_template_option(connection.alias, 'UNLOGGED', False):
+        return
+    if name is None:
+        name = connection.settings_dict['NAME']
+        connection.close()
+    copy = connection.__class__(
+        dict(connection.settings_dict, NAME=name), alias=connection.alias)
+    try:
+        with timed('unlogged', connection.alias):
+            execute_without_database(connection, 'ALTER DATABASE %s SET synchronous_commit = off' % (
+                connection.ops.quote_name(name)))
+            if not tables:
+                return
+            with copy.cursor() as cursor:
+                cursor.execute(LOGGED_TABLES_SQL)
+                logged = [row[0] for row in cursor.fetchall()]
+                # A logged table can't reference an unlogged table, so the
+                # referencing tables have to go first.
+                while logged:
+                    remaining = []
+                    for table in logged:
+                        try:
+                            cursor.execute('ALTER TABLE %s SET UNLOGGED' % table)
+                        except DatabaseError:
+                            remaining.append(table)
+                    if len(remaining) == len(logged):
+                        break
+                    logged = remaining
+    finally:
+        copy.close()
+
+
+def prewarm_database(connection, name=None):
+    """Load the relations in the PREWARM option into the buffer cache.
+
+    name is the name of the copy to warm up, by default the database of the
+    connection. pg_prewarm has to be installed in the template database.
+
+    """
+    relations = get_template_option(connection.alias, 'PREWARM', ())
+    if not relations:
+        return
+    if name is not None:
+        settings_dict = dict(connection.settings_dict, NAME=name)
+        connection = connection.__class__(settings_dict, alias=connection.alias)
+    try:
+        with timed('prewarm', connection.alias):
+            with connection.cursor() as cursor:
+                for relation in relations:
+                    cursor.execute('SELECT pg_prewarm(%s)', [relation])
+    finally:
+        if name is not None:
+            connection.close()
+
+
+def drop_database(connection, name):
+    """Drop a database if it exists.
+
+    Sessions still connected to a postgres database would block the drop, so
+    they are terminated first, or by the drop itself (WITH (FORCE)) from
+    postgres 13 on.
+
+    """
+    sql = 'DROP DATABASE IF EXISTS %s' % connection.ops.quote_name(name)
+    with timed('drop', connection.alias):
+        if connection.vendor == 'postgresql':
+            if get_server_version(connection) >= 130000:
+                sql += ' WITH (FORCE)'
+            else:
+                terminate_database_sessions(connection, name)
+        execute_without_database(connection, sql)
+
+
+def run_concurrently(tasks, max_workers=None):
+    """Run the tasks in threads and wait for all of them to finish.
+
+    At most max_workers tasks run at the same time, by default every task
+    gets its own thread. The first exception raised by a task is raised again
+    once every task has finished.
+
+    """
+    errors = []
+    tasks = list(tasks)
+
+    def run():
+        while True:
+            try:
+                task = tasks.pop(0)
+            except IndexError:
+                return
+            try:
+                task()
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=run)
+               for i in range(min(max_workers or len(tasks), len(tasks)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+def ensure_template_database(db_name):
+    """Create the template test database if its creation was deferred.
+
+    Returns True if the database was created.
+
+    """
     from django.db import connections
 
-    connection_patch = mock.patch(
-        'django.db.connections._connections.default',
-        connections[db_name])
+    creation = connections[db_name].creation
+    create = getattr(creation, 'ttdb_lazy', None)
+    if create is None:
+        return False
+    creation.ttdb_lazy = None
+    create()
+    return True
+
 
-    settings_patch = mock.patch(
-        'django.db.connections.databases',
-        {'default': settings.DATABASES.get(db_name)})
+def enable_template_database(db_name, shared=False, scope_key=None):
+    """Route the default database to the template database.
 
-    connection_patch.start()
-    settings_patch.start()
+    The default database is only routed in the current thread or asyncio
+    task and the threads without a route of their own, unless shared is True.
+    If the creation or a reload of the database was deferred the database is
+    created or reloaded first. It is reloaded as well if it was left to the
+    tests of another class or module scope (see finish_template_test).
+    Returns the route, which is passed to restore_default_database.
 
-    return connection_patch, settings_patch
+    """
+    from django.db import connections
+
+    ensure_template_database(db_name)
+    connection = connections[db_name]
+    if getattr(connection, 'ttdb_scope_key', None) not in (None, scope_key):
+        connection.ttdb_scope_key = None
+        if template_database_needs_reload(db_name):
+            connection.ttdb_reload_pending = True
+    if getattr(connection, 'ttdb_reload_pending', False):
+        reload_template_database(db_name)
+
+    route = TemplateDatabaseRoute(db_name, shared)
+    with timed('switch', db_name):
+        route.start()
+    return route
 
 
 def reload_template_database(db_name):
-    """Drops and creates the template database."""
+    """Drops and creates the template database.
+
+    If the template database has a reset backend it is used to reset the
+    database instead. Depending on the reload mode (see get_reload_mode) only
+    the modified tables or every table are restored from snapshots, unless the
+    modifications are unknown. If the runner keeps a pool of spare databases
+    for this template then a spare is swapped in and the old database is
+    dropped in the background.
+
+    """
+    from django.db import connections
+
+    if ensure_template_database(db_name):
+        return
+
+    with timed('reload', db_name):
+        connection = connections[db_name]
+        backend = get_reset_backend(db_name)
+        if backend is not None and backend.reset():
+            reset_tracking(connection)
+            connection.ttdb_reload_pending = False
+            return
+
+        mode = get_reload_mode(db_name)
+        restored = (
+            (mode == 'tables' and restore_modified_tables(connection)) or
+            (mode == 'copy' and restore_all_tables(
+                connection, not template_database_needs_reload(db_name))))
+        pool = getattr(connection.creation, 'ttdb_pool', None)
+        if not restored and (pool is None or not pool.swap()):
+            # Recreate the database under its current name, which is not the
+            # default test database name in parallel test workers.
+            test_database_name = connection.settings_dict['NAME']
+            connection.creation.destroy_test_db(
+                connection.settings_dict['ORIGINAL_NAME'], 0)
+            connection.settings_dict['NAME'] = connection.settings_dict['ORIGINAL_NAME']
+            with mock.patch.object(connection.creation, '_get_test_db_name',
+                                   return_value=test_database_name):
+                connection.creation.create_test_db(verbosity=0, reload=True)
+        reset_tracking(connection)
+        connection.ttdb_reload_pending = False
+
+
+def schedule_template_database_reload(db_name):
+    """Reload the template test database after a test.
+
+    With the DEFER_RELOAD option enabled the reload is deferred until the
+    database is used again, so consecutive tests that don't need a fresh
+    database and the last test of the run don't trigger a reload at all.
+
+    """
+    from django.db import connections
+
+    if get_template_option(db_name, 'DEFER_RELOAD', False):
+        connections[db_name].ttdb_reload_pending = True
+    else:
+        reload_template_database(db_name)
+
+
+def finish_template_test(db_name, scope, scope_key=None):
+    """Reload the template test database after a test if its scope ends.
+
+    Tests in the 'method' scope get a fresh database. In the 'class' and
+    'module' scopes the database is left to the next test with the same scope
+    key and reloaded when a test with another key uses it. Tests in the
+    'session' scope never reload it.
+
+    """
+    from django.db import connections
+
+    if scope in ('class', 'module'):
+        connections[db_name].ttdb_scope_key = scope_key
+    elif scope == 'method' and template_database_needs_reload(db_name):
+        schedule_template_database_reload(db_name)
+
+
+def get_reload_mode(db_name):
+    """Return how a template database is reloaded.
+
+    Either 'clone' (recreate the database from the template), 'tables'
+    (restore the modified tables) or 'copy' (restore every table). The runner
+    decides on the mode when the database is created, otherwise the
+    RELOAD_MODE option is used.
+
+    """
     from django.db import connections
 
+    mode = getattr(connections[db_name].creation, 'ttdb_reload_mode', None)
+    return mode or get_template_option(db_name, 'RELOAD_MODE', 'clone')
+
+
+def template_database_needs_reload(db_name):
+    """Return False if the template test database is known to be unmodified.
+
+    Only applies when the RELOAD_ONLY_DIRTY option is enabled, otherwise the
+    database is always reloaded.
+
+    """
+    from django.db import connections
+
+    if not get_template_option(db_name, 'RELOAD_ONLY_DIRTY', False):
+        return True
+    return is_dirty(connections[db_name])
+
+
+def mark_template_database_dirty(db_name):
+    """Mark the template test database as modified.
+
+    Used when the database may have been modified without the writes being
+    tracked, for example by another process.
+
+    """
+    from django.db import connections
+
+    mark_dirty(connections[db_name])
+
+
+def restore_default_database(route):
+    """Stop the route to restore the default database."""
+    with timed('restore', route.db_name):
+        route.stop()
+
+
+def run_commit_hooks(connection):
+    """Run the on_commit callbacks registered on the connection."""
+    while connection.run_on_commit:
+        callback = connection.run_on_commit.pop(0)
+        callback[1]()
+
+
+def start_savepoint_isolation(db_name):
+    """Open an atomic block on the template test database.
+
+    Everything the test does on the database happens inside this block and is
+    rolled back by end_savepoint_isolation, so the database never has to be
+    reloaded. Atomic blocks opened by the test itself become savepoints.
+
+    The on_commit callbacks run as if the test committed its transactions:
+    right away when no atomic block of the test is open, or when the outermost
+    atomic block of the test exits successfully.
+
+    """
+    from django.db import connections
+    from django.db import transaction
+
+    atomic = transaction.atomic(using=db_name)
+    atomic.__enter__()
     connection = connections[db_name]
-    connection.creation.destroy_test_db(
-        connection.settings_dict['ORIGINAL_NAME'], 0)
-    connection.settings_dict['NAME'] = connection.settings_dict['ORIGINAL_NAME']
-    connection.creation.create_test_db(verbosity=0, reload=True)
+    if not hasattr(connection, 'run_on_commit'):
+        # django < 1.9
+        return atomic
+
+    on_commit = connection.on_commit
+    savepoint_commit = connection.savepoint_commit
 
+    def on_commit_in_test(func):
+        on_commit(func)
+        if not connection.savepoint_ids:
+            run_commit_hooks(connection)
 
-def restore_default_database(connection_patch, settings_patch):
-    """Stop the patches to restore the default database."""
-    connection_patch.stop()
-    settings_patch.stop()
+    def savepoint_commit_in_test(sid):
+        savepoint_commit(sid)
+        if not connection.savepoint_ids:
+            run_commit_hooks(connection)
+
+    connection.on_commit = on_commit_in_test
+    connection.savepoint_commit = savepoint_commit_in_test
+    return atomic
+
+
+def end_savepoint_isolation(db_name, atomic, exc_info=(None, None, None)):
+    """Roll back the atomic block opened by start_savepoint_isolation.
+
+    The on_commit callbacks of atomic blocks that the test did not exit
+    successfully are discarded, because their changes are rolled back.
+
+    """
+    from django.db import connections
+    from django.db import transaction
+
+    connection = connections[db_name]
+    for name in ('on_commit', 'savepoint_commit'):
+        connection.__dict__.pop(name, None)
+    connection.run_on_commit = []
+    transaction.set_rollback(True, using=db_name)
+    atomic.__exit__(*exc_info)